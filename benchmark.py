@@ -0,0 +1,65 @@
+import argparse
+import json
+import threading
+import time
+from grab_loop import GrabLoop
+from detector_loop import DetectorLoop
+from frame_source import create_source
+from metrics import MetricsServer
+import metrics
+
+
+def run_benchmark(source_name, sink_name, seconds, paced, detect):
+    grab_loop = GrabLoop()
+    threads = [threading.Thread(target=grab_loop.run)]
+    if detect:
+        detector_loop = DetectorLoop()
+        grab_loop.add_frame_consumer(detector_loop.send_frame)
+        detector_loop.found_face.connect(grab_loop.send_face)
+        grab_loop.track_lost.connect(detector_loop.request_detection)
+        threads.append(threading.Thread(target=detector_loop.run))
+
+    grab_loop.set_source(create_source(source_name), sink_name)
+    grab_loop.sink.paced = paced
+    sink = grab_loop.sink
+
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    grab_loop.stop()
+    if detect:
+        detector_loop.stop()
+    for thread in threads:
+        thread.join()
+
+    if hasattr(sink, "stats"):
+        return sink.stats()
+    return {}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the grab pipeline headless and report throughput")
+    parser.add_argument("--source", default="synthetic",
+                        choices=["synthetic", "emulation", "replay"])
+    parser.add_argument("--sink", default="counting",
+                        choices=["counting", "null", "virtualcam"])
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--unpaced", action="store_true",
+                        help="send frames as fast as possible")
+    parser.add_argument("--no-detect", action="store_true",
+                        help="don't run the face detector")
+    parser.add_argument("--metrics", action="store_true",
+                        help="also print the latency histograms and counters")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the metrics on localhost while running")
+    args = parser.parse_args()
+
+    if not args.metrics_port is None:
+        metrics_server = MetricsServer(args.metrics_port)
+        metrics_server.start()
+    stats = run_benchmark(args.source, args.sink, args.seconds,
+                          not args.unpaced, not args.no_detect)
+    if args.metrics:
+        stats["metrics"] = metrics.snapshot()
+    print(json.dumps(stats, indent=4))
@@ -0,0 +1,16 @@
+class Callbacks:
+
+    # what pyqtSignal does for the pipeline without Qt, the callbacks run in
+    # the thread that emits, e.g. the grab loop
+    def __init__(self):
+        self.callbacks = []
+
+    def connect(self, callback):
+        self.callbacks.append(callback)
+
+    def disconnect(self, callback):
+        self.callbacks.remove(callback)
+
+    def emit(self, *args):
+        for callback in list(self.callbacks):
+            callback(*args)
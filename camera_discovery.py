@@ -0,0 +1,39 @@
+from PyQt5.QtCore import *
+
+
+class CameraDiscovery(QObject):
+
+    # (friendly name, full name) of every device that was found
+    devices_found = pyqtSignal(list)
+    refresh_requested = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        # the last enumeration, shown right away while a new one runs
+        self.devices = []
+        self.refreshing = False
+        self.thread = QThread()
+        self.moveToThread(self.thread)
+        self.refresh_requested.connect(self.enumerate_devices)
+        self.thread.start()
+
+    def refresh(self):
+        # enumerating can take seconds with GigE cameras, so it never runs
+        # in the GUI thread and requests pile up into a single run
+        if not self.refreshing:
+            self.refreshing = True
+            self.refresh_requested.emit()
+
+    def enumerate_devices(self):
+        # pypylon is only imported here, off the startup path
+        from pypylon import pylon
+        devices = [(device.GetFriendlyName(), device.GetFullName())
+                   for device in pylon.TlFactory.GetInstance().EnumerateDevices()]
+        self.refreshing = False
+        if devices != self.devices:
+            self.devices = devices
+            self.devices_found.emit(devices)
+
+    def close(self):
+        self.thread.quit()
+        self.thread.wait()
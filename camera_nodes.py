@@ -0,0 +1,170 @@
+import threading
+import time
+from concurrent import futures
+from pypylon import genicam
+import metrics
+
+
+def is_writable(camera, name):
+    node = camera.GetNodeMap().GetNode(name)
+    return node is not None and genicam.IsWritable(node)
+
+
+def set_int_value(feature, value):
+    val_0_min = value - feature.Min
+    val_corr_inc = (val_0_min // feature.Inc) * feature.Inc
+
+    val = min(max(val_corr_inc + feature.Min, feature.Min), feature.Max)
+
+    feature.Value = int(val)
+
+
+# writing one of these changes the limits of the listed nodes
+LIMIT_DEPENDENCIES = {
+    "Width": ["OffsetX", "AutoFunctionROIWidth", "AutoFunctionROIOffsetX"],
+    "Height": ["OffsetY", "AutoFunctionROIHeight", "AutoFunctionROIOffsetY"],
+    "OffsetX": ["Width"],
+    "OffsetY": ["Height"],
+    "AutoFunctionROIWidth": ["AutoFunctionROIOffsetX"],
+    "AutoFunctionROIHeight": ["AutoFunctionROIOffsetY"],
+    "AutoFunctionROIOffsetX": ["AutoFunctionROIWidth"],
+    "AutoFunctionROIOffsetY": ["AutoFunctionROIHeight"],
+}
+
+
+class NodeCache:
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.values = {}
+        self.limits = {}
+        self.num_reads = 0
+        self.num_writes = 0
+        self.num_skipped_writes = 0
+
+    def snapshot(self, names):
+        for name in names:
+            self.get(name)
+            self.get_limits(name)
+
+    def invalidate(self):
+        self.values = {}
+        self.limits = {}
+
+    def get(self, name):
+        if not name in self.values:
+            self.values[name] = getattr(self.camera, name).Value
+            self.num_reads += 1
+        return self.values[name]
+
+    def get_limits(self, name):
+        if not name in self.limits:
+            feature = getattr(self.camera, name)
+            self.limits[name] = (feature.Min, feature.Max, feature.Inc)
+            self.num_reads += 3
+        return self.limits[name]
+
+    def set(self, name, value):
+        if self.values.get(name) == value:
+            self.num_skipped_writes += 1
+            return
+        self.write(name, value)
+
+    def write(self, name, value):
+        getattr(self.camera, name).Value = value
+        self.num_writes += 1
+        self.values[name] = value
+        for dependency in LIMIT_DEPENDENCIES.get(name, []):
+            self.limits.pop(dependency, None)
+
+    def set_int(self, name, value):
+        (min_value, max_value, inc) = self.get_limits(name)
+        value = ((value - min_value) // inc) * inc + min_value
+        self.set(name, int(min(max(value, min_value), max_value)))
+
+    def counters(self):
+        return {
+            "reads": self.num_reads,
+            "writes": self.num_writes,
+            "skipped_writes": self.num_skipped_writes,
+        }
+
+
+class CommandQueue:
+
+    # feature writes from other threads, applied by the grab loop between
+    # two frames so they never race with its own node access
+    def __init__(self, min_interval=0.05, labels=None):
+        self.lock = threading.Lock()
+        self.min_interval = min_interval
+        # only the latest value per feature is kept, a slider drag costs
+        # at most one write per feature and interval
+        self.pending = {}
+        self.last_writes = {}
+        # what was written since the camera was connected, written again
+        # after a reconnect
+        self.applied = {}
+        # reads are served the same way, with the value of the next loop
+        self.reads = []
+        labels = labels or {}
+        self.num_applied = metrics.counter(
+            "camera_commands_total", result="applied", **labels)
+        self.num_coalesced = metrics.counter(
+            "camera_commands_total", result="coalesced", **labels)
+        self.num_failed = metrics.counter(
+            "camera_commands_total", result="failed", **labels)
+
+    def put(self, name, value):
+        with self.lock:
+            if name in self.pending:
+                self.num_coalesced.inc()
+                del self.pending[name]
+            self.pending[name] = value
+
+    def get(self, name, timeout=1.0):
+        future = futures.Future()
+        with self.lock:
+            self.reads.append((name, future))
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            raise ValueError(f"Feature '{name}' couldn't be read, the camera "
+                             "isn't grabbing")
+
+    def clear(self):
+        with self.lock:
+            self.pending = {}
+            self.last_writes = {}
+            self.applied = {}
+
+    def restore(self):
+        with self.lock:
+            self.pending = dict(self.applied, **self.pending)
+            self.last_writes = {}
+
+    def apply(self, camera):
+        if len(self.pending) == 0 and len(self.reads) == 0:
+            return
+        now = time.perf_counter()
+        with self.lock:
+            ready = [(name, value) for name, value in self.pending.items()
+                     if now - self.last_writes.get(name, 0) >= self.min_interval]
+            for name, value in ready:
+                del self.pending[name]
+                self.last_writes[name] = now
+            reads = self.reads
+            self.reads = []
+        for name, value in ready:
+            try:
+                getattr(camera, name).Value = value
+                self.applied[name] = value
+                self.num_applied.inc()
+            except genicam.GenericException:
+                # e.g. a value the camera doesn't accept in its current
+                # state, grabbing goes on without it
+                self.num_failed.inc()
+        for name, future in reads:
+            try:
+                future.set_result(getattr(camera, name).Value)
+            except (AttributeError, genicam.GenericException) as e:
+                future.set_exception(e)
@@ -1,23 +1,27 @@
-from pypylon import pylon
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
+from camera_discovery import CameraDiscovery
+import settings
 
 
 class ConfigGui(QWidget):
 
-    def __init__(self, grab_thread, preview_thread, face_detector_thread):
+    def __init__(self):
         super().__init__()
 
         vbox = QVBoxLayout()
         self.camera = None
+        self.grab_thread = None
+        self.full_name_list = []
 
         self.camera_list = QComboBox()
+        self.camera_list.setDisabled(True)
         self.discover_button = QPushButton("Discover")
         self.discover_button.clicked.connect(self.discover_cameras)
         self.connect_button = QPushButton("Open")
+        self.connect_button.setDisabled(True)
         self.connect_button.clicked.connect(self.connect_camera)
-        self.discover_cameras()
 
         discover_box = QHBoxLayout()
         discover_box.addWidget(self.camera_list)
@@ -45,13 +49,29 @@ class ConfigGui(QWidget):
         self.setWindowTitle("Pylon Webcam")
 
         self.setup_minimize_to_tray()
+        self.show()
 
+        self.discovery = CameraDiscovery()
+        self.discovery.devices_found.connect(self.update_camera_list)
+        # the discovery object lives in its own thread, which is stopped from here
+        qApp.aboutToQuit.connect(self.discovery.close, Qt.DirectConnection)
+        self.discovery_timer = QTimer()
+        self.discovery_timer.timeout.connect(self.discover_cameras)
+        interval = settings.get_setting("discovery_interval", 5)
+        if interval > 0:
+            self.discovery_timer.start(int(interval * 1000))
+        self.discover_cameras()
+
+    def attach_threads(self, grab_thread, preview_thread, face_detector_thread):
+        # the threads come after the window, their modules pull in numpy,
+        # OpenCV and pylon
         self.grab_thread = grab_thread
         self.thread = QThread()
         self.grab_thread.moveToThread(self.thread)
         self.thread.started.connect(self.grab_thread.run)
         self.grab_thread.finished.connect(self.grab_thread_finished)
         self.grab_thread.avg_fps.connect(self.update_avg_fps)
+        self.grab_thread.reconnected.connect(self.camera_reconnected)
 
         self.preview_thread = preview_thread
         self.prev_thread = QThread()
@@ -65,8 +85,7 @@ class ConfigGui(QWidget):
         self.face_detector_thread.moveToThread(self.face_thread)
         self.face_thread.started.connect(self.face_detector_thread.run)
         self.face_thread.start()
-
-        self.show()
+        self.update_camera_list(self.discovery.devices)
 
     def setup_minimize_to_tray(self):
         self.tray_icon = QSystemTrayIcon(self)
@@ -128,16 +147,28 @@ class ConfigGui(QWidget):
         self.avg_fps_label.setText("FPS: {:2.2f}".format(value))
 
     def discover_cameras(self):
-        self.full_name_list = []
-        self.camera_list.clear()
-        devices = pylon.TlFactory.GetInstance().EnumerateDevices()
+        # an open camera stays in the list, there is nothing to look for
+        if self.camera is None:
+            self.discovery.refresh()
+
+    def update_camera_list(self, devices):
+        # only the devices that came or went are touched, the selection
+        # stays where it is
+        full_names = [full_name for (name, full_name) in devices]
+        for i in reversed(range(len(self.full_name_list))):
+            if not self.full_name_list[i] in full_names:
+                self.camera_list.removeItem(i)
+                del self.full_name_list[i]
+        for (name, full_name) in devices:
+            if not full_name in self.full_name_list:
+                self.camera_list.addItem(name)
+                self.full_name_list.append(full_name)
         self.camera_list.setDisabled(len(devices) == 0)
-        self.connect_button.setDisabled(len(devices) == 0)
-        for cam in devices:
-            self.camera_list.addItem(cam.GetFriendlyName())
-            self.full_name_list.append(cam.GetFullName())
+        self.connect_button.setDisabled(
+            len(devices) == 0 or self.grab_thread is None)
 
     def connect_camera(self):
+        from pypylon import pylon
         if self.camera is None:
             try:
                 self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateDevice(
@@ -170,58 +201,56 @@ class ConfigGui(QWidget):
             self.thread.exit()
             self.thread.wait()
 
+    def camera_reconnected(self):
+        # the widgets still hold the features of the lost device
+        if not self.camera is None:
+            self.setup_camera_features()
+
     def setup_camera_features(self):
         clearLayout(self.camera_feature_box)
+        commands = self.grab_thread.commands
 
         if hasattr(self.camera, "BslLightSourcePreset"):
             self.light_source_enum = EnumFeature(
-                self.camera.BslLightSourcePreset, "LightSource")
+                self.camera.BslLightSourcePreset, "LightSource", commands)
             self.camera_feature_box.addLayout(
                 self.light_source_enum.get_layout())
 
         if hasattr(self.camera, "AutoTargetBrightness"):
             self.auto_brightness_slider = SliderFeature(
-                self.camera.AutoTargetBrightness, "AutoBrightness")
+                self.camera.AutoTargetBrightness, "AutoBrightness", commands)
             self.camera_feature_box.addLayout(
                 self.auto_brightness_slider.get_layout())
 
-        if hasattr(self.camera, "Gamma"):
-            self.gamma_slider = SliderFeature(self.camera.Gamma, "Gamma")
-            self.camera_feature_box.addLayout(self.gamma_slider.get_layout())
-
-        if hasattr(self.camera, "BslContrast"):
-            self.contrast_slider = SliderFeature(
-                self.camera.BslContrast, "Contrast")
-            self.camera_feature_box.addLayout(
-                self.contrast_slider.get_layout())
-
-        if hasattr(self.camera, "BslBrightness"):
-            self.brightness_slider = SliderFeature(
-                self.camera.BslBrightness, "Brightness")
-            self.camera_feature_box.addLayout(
-                self.brightness_slider.get_layout())
-
-        if hasattr(self.camera, "BslSaturation"):
-            self.saturation_slider = SliderFeature(
-                self.camera.BslSaturation, "Saturation")
-            self.camera_feature_box.addLayout(
-                self.saturation_slider.get_layout())
-
-        if hasattr(self.camera, "BslHue"):
-            self.hue_slider = SliderFeature(self.camera.BslHue, "Hue")
-            self.camera_feature_box.addLayout(self.hue_slider.get_layout())
+        # without the Bsl nodes the frames are corrected on the host
+        self.add_color_slider("Gamma", "color_gamma", "Gamma")
+        self.add_color_slider("BslContrast", "color_contrast", "Contrast")
+        self.add_color_slider("BslBrightness", "color_brightness", "Brightness")
+        self.add_color_slider("BslSaturation", "color_saturation", "Saturation")
+        self.add_color_slider("BslHue", "color_hue", "Hue")
 
         if hasattr(self.camera, "BslSharpnessEnhancement"):
             self.sharpness_slider = SliderFeature(
-                self.camera.BslSharpnessEnhancement, "Sharpness")
+                self.camera.BslSharpnessEnhancement, "Sharpness", commands)
             self.camera_feature_box.addLayout(
                 self.sharpness_slider.get_layout())
 
         if hasattr(self.camera, "BslNoiseReduction"):
             self.noise_slider = SliderFeature(
-                self.camera.BslNoiseReduction, "NoiseReduction")
+                self.camera.BslNoiseReduction, "NoiseReduction", commands)
             self.camera_feature_box.addLayout(self.noise_slider.get_layout())
 
+    def add_color_slider(self, node_name, setting_name, name):
+        if hasattr(self.camera, node_name):
+            slider = SliderFeature(getattr(self.camera, node_name), name,
+                                   self.grab_thread.commands)
+        else:
+            from stages import COLOR_SETTINGS
+            slider = SliderFeature(SoftwareFeature(
+                setting_name, *COLOR_SETTINGS[setting_name]), name)
+        setattr(self, name.lower() + "_slider", slider)
+        self.camera_feature_box.addLayout(slider.get_layout())
+
 
 def clearLayout(layout):
     if layout is not None:
@@ -234,10 +263,20 @@ def clearLayout(layout):
                 clearLayout(item.layout())
 
 
+def write_feature(feature, value, commands):
+    # camera writes go through the grab loop, it applies the latest value
+    # between two frames
+    if commands is None:
+        feature.Value = value
+    else:
+        commands.put(feature.GetNode().GetName(), value)
+
+
 class SliderFeature:
 
-    def __init__(self, feature, name):
+    def __init__(self, feature, name, commands=None):
         self.feature = feature
+        self.commands = commands
         if self.feature.HasInc():
             self.SLIDER_INC = self.feature.Inc
         else:
@@ -271,20 +310,53 @@ class SliderFeature:
         return self.layout
 
     def value_changed_spin(self, value):
-        self.feature.Value = value
+        write_feature(self.feature, value, self.commands)
         if value != self.slider.value():
             self.slider.setValue(value)
 
     def value_changed_slider(self, value):
-        self.feature.Value = value
+        write_feature(self.feature, value, self.commands)
         if value != self.spin_box.value():
             self.spin_box.setValue(value)
 
 
+class SoftwareFeature:
+
+    # looks like a camera float node to SliderFeature, the value is a
+    # setting that the lut stage applies to every frame
+    def __init__(self, setting_name, default, minimum, maximum):
+        self.setting_name = setting_name
+        self.default = default
+        self.Min = minimum
+        self.Max = maximum
+        # the frames follow the slider right away, the file is only
+        # written once it stands still
+        self.save_timer = QTimer()
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(500)
+        self.save_timer.timeout.connect(settings.save_settings)
+
+    def HasInc(self):
+        return False
+
+    @property
+    def Value(self):
+        return settings.get_setting(self.setting_name, self.default)
+
+    @Value.setter
+    def Value(self, value):
+        # the slider and the spin box echo each other's changes
+        if value == self.Value:
+            return
+        settings.set_setting(self.setting_name, value, persist=False)
+        self.save_timer.start()
+
+
 class EnumFeature:
 
-    def __init__(self, feature, name):
+    def __init__(self, feature, name, commands=None):
         self.feature = feature
+        self.commands = commands
         self.label = QLabel(name)
         self.combobox = QComboBox()
         self.enumText = self.feature.GetSymbolics()
@@ -302,7 +374,7 @@ class EnumFeature:
         return self.layout
 
     def index_changed(self, index):
-        self.feature.Value = self.combobox.currentText()
+        write_feature(self.feature, self.combobox.currentText(), self.commands)
 
 
 class DoubleSlider(QSlider):
@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+from grab_loop import GrabLoop
+from detector_loop import DetectorLoop
+from frame_source import PylonSource, create_source, open_camera
+from camera_nodes import is_writable
+import settings
+import metrics
+
+
+class HeadlessPipeline:
+
+    def __init__(self, source_name="pylon", serial=None, sink_name=None,
+                 sink_device=None):
+        self.source_name = source_name
+        self.serial = serial
+        self.sink_name = sink_name
+        self.sink_device = sink_device
+        self.lock = threading.Lock()
+        self.grab_loop = GrabLoop(serial or source_name)
+        self.detector_loop = DetectorLoop()
+        # the callbacks run in the emitting thread
+        self.grab_loop.add_frame_consumer(self.detector_loop.send_frame)
+        self.detector_loop.found_face.connect(self.grab_loop.send_face)
+        self.grab_loop.track_lost.connect(
+            self.detector_loop.request_detection)
+        self.detector = threading.Thread(target=self.detector_loop.run)
+        self.detector.start()
+        self.grabber = None
+
+    def is_open(self):
+        return not self.grabber is None and self.grabber.is_alive()
+
+    def open(self, serial=None):
+        with self.lock:
+            if self.is_open():
+                raise ValueError("The camera is already open")
+            if not self.grabber is None:
+                # the last session ended on its own, e.g. after a camera error
+                self.grabber.join()
+            if self.source_name == "pylon":
+                source = PylonSource(open_camera(serial or self.serial))
+            else:
+                source = create_source(self.source_name)
+            self.grab_loop.set_source(source, self.sink_name, self.sink_device)
+            self.grabber = threading.Thread(target=self.grab_loop.run)
+            self.grabber.start()
+
+    def close(self):
+        with self.lock:
+            if not self.is_open():
+                raise ValueError("The camera is not open")
+            self.grab_loop.stop()
+            self.grabber.join()
+            self.grabber = None
+
+    def camera(self):
+        source = self.grab_loop.source
+        if not self.is_open() or source is None or source.camera is None:
+            raise ValueError("There is no open camera")
+        return source.camera
+
+    def set_feature(self, name, value):
+        camera = self.camera()
+        if not is_writable(camera, name):
+            raise ValueError(f"Feature '{name}' is not writable")
+        # written by the grab loop between two frames, and again after a
+        # reconnect
+        self.grab_loop.commands.put(name, value)
+
+    def get_feature(self, name):
+        self.camera()
+        # read by the grab loop as well, it owns the camera while grabbing
+        return self.grab_loop.commands.get(name)
+
+    def stats(self, include_metrics=False):
+        result = {"open": self.is_open(), "source": self.source_name}
+        sink = self.grab_loop.sink
+        if self.is_open() and not sink is None:
+            result["fps"] = sink.avg_fps
+            if hasattr(sink, "stats"):
+                result["sink"] = sink.stats()
+        if include_metrics:
+            result["metrics"] = metrics.snapshot()
+        return result
+
+    def shutdown(self):
+        if self.is_open():
+            self.close()
+        self.detector_loop.stop()
+        self.detector.join()
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+
+    # one JSON object per line in both directions, e.g.
+    # {"command": "set_feature", "name": "Gamma", "value": 1.2}
+    def handle(self):
+        for line in self.rfile:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                request = json.loads(line)
+                reply = {"ok": True,
+                         "result": self.server.run_command(request)}
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, pipeline):
+        # a socket left behind by a daemon that didn't exit cleanly
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, ControlHandler)
+        self.path = path
+        self.pipeline = pipeline
+        self.commands = {
+            "open": lambda request: pipeline.open(request.get("serial")),
+            "close": lambda request: pipeline.close(),
+            "set_feature": lambda request: pipeline.set_feature(
+                request["name"], request["value"]),
+            "get_feature": lambda request: pipeline.get_feature(request["name"]),
+            "set_setting": lambda request: settings.set_setting(
+                request["name"], request["value"]),
+            "reload_settings": lambda request: settings.reload_settings(),
+            "stats": lambda request: pipeline.stats(request.get("metrics", False)),
+            "shutdown": lambda request: threading.Thread(
+                target=self.shutdown).start(),
+        }
+
+    def run_command(self, request):
+        command = request.get("command")
+        if not command in self.commands:
+            raise ValueError(f"Unknown command '{command}'")
+        return self.commands[command](request)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def send_command(path, command, **arguments):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as control:
+        control.connect(path)
+        request = dict(arguments, command=command)
+        control.sendall((json.dumps(request) + "\n").encode())
+        reply = json.loads(control.makefile().readline())
+    if not reply["ok"]:
+        raise RuntimeError(reply["error"])
+    return reply["result"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the camera pipeline without a GUI, controlled "
+                    "through a unix socket")
+    parser.add_argument("--socket", default=settings.get_setting(
+        "control_socket", "/tmp/pylon_webcam.sock"))
+    parser.add_argument("--source", default="pylon",
+                        choices=["pylon", "emulation", "synthetic", "replay"])
+    parser.add_argument("--serial", help="camera to open, default is the first one")
+    parser.add_argument("--sink", choices=["virtualcam", "null", "counting"],
+                        help="default is the sink setting")
+    parser.add_argument("--device", help="virtual camera device")
+    parser.add_argument("--no-open", action="store_true",
+                        help="wait for an open command")
+    parser.add_argument("--command",
+                        help="send a command to a running daemon and exit")
+    parser.add_argument("--arguments", default="{}",
+                        help="JSON object with the arguments of --command")
+    args = parser.parse_args()
+
+    if not args.command is None:
+        print(json.dumps(send_command(args.socket, args.command,
+                                      **json.loads(args.arguments)), indent=4))
+    else:
+        pipeline = HeadlessPipeline(args.source, args.serial, args.sink,
+                                    args.device)
+        server = ControlServer(args.socket, pipeline)
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: threading.Thread(
+                          target=server.shutdown).start())
+        if not args.no_open:
+            pipeline.open()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        pipeline.shutdown()
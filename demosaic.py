@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+# pylon names a pattern after its first row, OpenCV after the second one
+BAYER_CODES = {
+    "BayerRG": cv2.COLOR_BayerBG2BGR,
+    "BayerBG": cv2.COLOR_BayerRG2BGR,
+    "BayerGR": cv2.COLOR_BayerGB2BGR,
+    "BayerGB": cv2.COLOR_BayerGR2BGR,
+}
+
+# rows above and below a stripe the interpolation needs to see
+STRIPE_BORDER = 2
+
+
+def parse_pixel_format(pixel_format):
+    pattern = pixel_format[:7]
+    bits = int("".join(c for c in pixel_format[7:] if c.isdigit()))
+    return pattern, bits
+
+
+class Demosaicer:
+
+    def __init__(self, width, height, pixel_format, num_threads=None):
+        pattern, self.bits = parse_pixel_format(pixel_format)
+        self.code = BAYER_CODES[pattern]
+        if num_threads is None:
+            num_threads = max(os.cpu_count() // 2, 1)
+        # stripes start on even rows so every stripe sees the same pattern
+        stripe_height = -(-height // num_threads)
+        stripe_height += stripe_height % 2
+        self.stripes = []
+        for start in range(0, height, stripe_height):
+            end = min(start + stripe_height, height)
+            border_start = max(start - STRIPE_BORDER, 0)
+            border_end = min(end + STRIPE_BORDER, height)
+            self.stripes.append((start, end, border_start, border_end,
+                                 np.empty((border_end - border_start, width), np.uint8),
+                                 np.empty((border_end - border_start, width, 3), np.uint8)))
+        self.executor = ThreadPoolExecutor(len(self.stripes))
+
+    def convert_stripe(self, raw, out, stripe):
+        (start, end, border_start, border_end, raw8, bgr) = stripe
+        src = raw[border_start:border_end]
+        if self.bits > 8:
+            cv2.convertScaleAbs(src, raw8, 1 / (1 << (self.bits - 8)))
+            src = raw8
+        cv2.cvtColor(src, self.code, dst=bgr)
+        out[start:end] = bgr[start - border_start:end - border_start]
+
+    def convert(self, raw, out):
+        # cv2 releases the GIL, so the stripes really run in parallel
+        futures = [self.executor.submit(self.convert_stripe, raw, out, stripe)
+                   for stripe in self.stripes]
+        for future in futures:
+            future.result()
+        return out
+
+    def close(self):
+        self.executor.shutdown()
@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import time
+import cv2
+import numpy as np
+from face_finder import DETECTORS, create_detector
+from raw_capture import CaptureReader
+
+
+def load_image_set(directory):
+    # faces.json maps image file names to their [x0, y0, x1, y1] face boxes
+    with open(os.path.join(directory, "faces.json")) as faces_file:
+        annotations = json.load(faces_file)
+    samples = []
+    for name, faces in sorted(annotations.items()):
+        img = cv2.imread(os.path.join(directory, name))
+        if img is None:
+            raise ValueError(f"Can't read '{name}'")
+        samples.append((img, np.array(faces, np.float64).reshape(-1, 4)))
+    return samples
+
+
+def load_capture(path, step):
+    # the faces the pipeline used while capturing are the ground truth
+    reader = CaptureReader(path)
+    samples = []
+    for i in range(0, len(reader), step):
+        face = reader.face(i)
+        faces = np.empty((0, 4)) if face is None else face.reshape(1, 4)
+        samples.append((np.array(reader.frame(i)), faces))
+    return samples
+
+
+def match_faces(truth, found, min_iou=0.5):
+    if len(truth) == 0 or len(found) == 0:
+        return 0
+    found = np.array(found, np.float64)[:, 1:5]
+    x0 = np.maximum(truth[:, None, 0], found[None, :, 0])
+    y0 = np.maximum(truth[:, None, 1], found[None, :, 1])
+    x1 = np.minimum(truth[:, None, 2], found[None, :, 2])
+    y1 = np.minimum(truth[:, None, 3], found[None, :, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area_truth = (truth[:, 2] - truth[:, 0]) * (truth[:, 3] - truth[:, 1])
+    area_found = (found[:, 2] - found[:, 0]) * (found[:, 3] - found[:, 1])
+    iou = intersection / (area_truth[:, None] + area_found[None, :] - intersection)
+    return int(np.sum(iou.max(axis=1) >= min_iou))
+
+
+def benchmark_detector(detector, samples, repeat):
+    detector.warm_up()
+    times = []
+    num_truth = 0
+    num_found = 0
+    num_matched = 0
+    for img, truth in samples:
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            faces = detector.detect(img)
+            times.append(time.perf_counter() - start_time)
+        num_truth += len(truth)
+        num_found += len(faces)
+        num_matched += match_faces(truth, faces)
+    times = np.array(times) * 1000
+    return {
+        "latency_ms": float(times.mean()),
+        "latency_p50_ms": float(np.percentile(times, 50)),
+        "latency_p95_ms": float(np.percentile(times, 95)),
+        "recall": num_matched / num_truth if num_truth > 0 else None,
+        "faces": num_found,
+        "false_detections": num_found - num_matched,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare latency and recall of the face detectors")
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument("--images",
+                      help="directory with images and a faces.json")
+    data.add_argument("--capture", help="raw capture with recorded faces")
+    parser.add_argument("--step", type=int, default=10,
+                        help="use every n-th frame of the capture")
+    parser.add_argument("--detectors", nargs="+", default=list(DETECTORS),
+                        choices=list(DETECTORS))
+    parser.add_argument("--input-size", type=int, nargs=2)
+    parser.add_argument("--backend", default="default")
+    parser.add_argument("--target", default="cpu")
+    parser.add_argument("--threads", type=int)
+    parser.add_argument("--confidence", type=float, default=0.7)
+    parser.add_argument("--onnx-model", help="model of the onnx detector")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.images is None:
+        samples = load_capture(args.capture, args.step)
+    else:
+        samples = load_image_set(args.images)
+    results = {}
+    for name in args.detectors:
+        try:
+            detector = create_detector(name, args.input_size, args.backend,
+                                       args.target, args.confidence,
+                                       args.onnx_model if name == "onnx" else None,
+                                       args.threads)
+        except (ValueError, cv2.error) as e:
+            # e.g. a model file that isn't there
+            results[name] = {"error": str(e)}
+            continue
+        results[name] = benchmark_detector(detector, samples, args.repeat)
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,192 @@
+import numpy as np
+import time
+import threading
+from face_finder import load_detector, stage_times
+from detector_process import ProcessDetector
+import settings
+import metrics
+from callbacks import Callbacks
+
+
+# changing these loads a new detector
+DETECTOR_SETTINGS = {
+    "detector", "detector_input_size", "detector_backend", "detector_target",
+    "detector_confidence", "detector_model", "detector_threads",
+}
+
+
+class DetectorClient:
+
+    def __init__(self, detector):
+        self.detector = detector
+        self.found_face = Callbacks()
+
+    def send_frame(self, slot):
+        self.detector.submit(self, slot)
+
+    def request_detection(self):
+        self.detector.request_detection()
+
+
+class DetectorLoop:
+
+    def __init__(self):
+        self.running = True
+        self.found_face = Callbacks()
+        self.detection_latency = Callbacks()
+        # latest frame of every client, the detector itself is the client
+        # of a single camera setup
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.wake_event = threading.Event()
+        self.detection_requested = False
+        # detections per second, 0 runs as often as max_load allows
+        self.fps = settings.get_setting("detector_fps", 0.1)
+        # share of wall clock time the detector may spend in find_faces
+        self.max_load = settings.get_setting("detector_max_load", 0.5)
+        self.detection_time = 0
+        # "process" runs the network in worker processes next to the GIL
+        # of the grab loop
+        self.mode = settings.get_setting("detector_mode", "thread")
+        self.num_processes = settings.get_setting("detector_processes", 2)
+        self.process_detector = None
+        self.detector = None
+        self.reload_detector = False
+        # frames replaced by a newer one before the detector got to them
+        self.dropped_frames = metrics.counter("detector_frames_dropped_total")
+        self.detection_times = metrics.histogram("detector_seconds")
+        settings.add_listener(self.settings_changed)
+
+    def settings_changed(self, changed):
+        if "detector_fps" in changed or "detector_max_load" in changed:
+            self.fps = settings.get_setting("detector_fps", 0.1)
+            self.max_load = settings.get_setting("detector_max_load", 0.5)
+            # a pending wait may be far too long for the new rate
+            self.detection_requested = True
+            self.wake_event.set()
+        if len(changed & DETECTOR_SETTINGS) > 0:
+            # worker processes pick up a new detector when they are started
+            self.reload_detector = True
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.wake_event.set()
+            self.condition.notify()
+
+    def request_detection(self):
+        # skip the rate limit once, e.g. when the tracker lost the face
+        self.detection_requested = True
+        self.wake_event.set()
+
+    def add_client(self):
+        return DetectorClient(self)
+
+    def send_frame(self, slot):
+        self.submit(self, slot)
+
+    def submit(self, client, slot):
+        # only the latest frame is kept, older ones are handed back right away
+        with self.condition:
+            if client in self.pending:
+                self.pending[client].release()
+                self.dropped_frames.inc()
+            self.pending[client] = slot
+            self.condition.notify()
+
+    def next_frames(self):
+        with self.condition:
+            while self.running and len(self.pending) == 0:
+                self.condition.wait()
+            pending = self.pending
+            self.pending = {}
+        return pending
+
+    def next_detection_time(self, start_time, end_time):
+        next_time = end_time
+        if self.fps > 0:
+            next_time = max(next_time, start_time + 1 / self.fps)
+        if self.max_load > 0:
+            next_time = max(next_time, end_time +
+                            self.detection_time * (1 / self.max_load - 1))
+        return next_time
+
+    def emit_faces(self, clients, faces):
+        self.faces = faces
+        for client, client_faces in zip(clients, faces):
+            if len(client_faces) > 0:
+                face = np.array(client_faces[0][1:5])
+                client.found_face.emit(face)
+
+    def collect_results(self):
+        while True:
+            result = self.process_detector.get_result()
+            if result is None:
+                break
+            clients, faces, self.detection_time, times = result
+            self.process_detector.worker_done()
+            for stage, taken in times.items():
+                stage_times[stage].merge(*taken)
+            self.emit_faces(clients, faces)
+            self.detection_times.observe(self.detection_time)
+            self.detection_latency.emit(self.detection_time)
+
+    def run(self):
+        if self.mode == "process":
+            self.process_detector = ProcessDetector(self.num_processes)
+            result_thread = threading.Thread(target=self.collect_results)
+            result_thread.start()
+
+        next_time = time.perf_counter()
+        while self.running:
+            # wait for the rate limit without waking up for every new frame
+            delay = next_time - time.perf_counter()
+            if delay > 0 and not self.detection_requested:
+                self.wake_event.wait(delay)
+                self.wake_event.clear()
+                continue
+            if not self.process_detector is None and \
+                    not self.process_detector.wait_for_worker(0.1):
+                continue
+            self.detection_requested = False
+
+            pending = self.next_frames()
+            if len(pending) == 0:
+                break
+            # the model is only loaded once there is something to detect,
+            # it stays off the startup path
+            if self.process_detector is None and \
+                    (self.detector is None or self.reload_detector):
+                self.reload_detector = False
+                self.detector = load_detector()
+
+            # frames of all cameras go through the network together
+            start_time = time.perf_counter()
+            clients = list(pending.keys())
+            frames = [pending[client].array for client in clients]
+            if self.process_detector is None:
+                self.emit_faces(clients, self.detector.detect_batch(frames))
+                end_time = time.perf_counter()
+                self.detection_time = end_time - start_time
+                self.detection_times.observe(self.detection_time)
+                self.detection_latency.emit(self.detection_time)
+            else:
+                # the frames are copied to shared memory, the workers'
+                # time is accounted for when their results come back
+                self.process_detector.submit(clients, frames)
+                end_time = time.perf_counter()
+            for slot in pending.values():
+                slot.release()
+            next_time = self.next_detection_time(start_time, end_time)
+
+        if not self.process_detector is None:
+            self.process_detector.close()
+            result_thread.join()
+            self.process_detector = None
+        self.detector = None
+
+        with self.condition:
+            for slot in self.pending.values():
+                slot.release()
+            self.pending = {}
+        self.running = True
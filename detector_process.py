@@ -0,0 +1,118 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def detector_worker(tasks, results):
+    # the network is loaded once per process
+    from face_finder import load_detector, stage_times
+    detector = load_detector()
+
+    buffers = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, frames = task
+        imgs = []
+        for name, shape in frames:
+            if not name in buffers:
+                buffers[name] = shared_memory.SharedMemory(name=name)
+            imgs.append(np.ndarray(shape, np.uint8, buffer=buffers[name].buf))
+
+        start_time = time.perf_counter()
+        faces = detector.detect_batch(imgs)
+        detection_time = time.perf_counter() - start_time
+        # plain tuples keep the result message small
+        faces = [[(float(conf), int(startX), int(startY), int(endX), int(endY))
+                  for (conf, startX, startY, endX, endY) in img_faces]
+                 for img_faces in faces]
+        del imgs
+        # the metrics are served by the main process, the stage times of
+        # this task go back with the faces
+        times = {stage: histogram.take() for stage, histogram in stage_times.items()}
+        results.put((task_id, faces, detection_time, times))
+
+    for buffer in buffers.values():
+        buffer.close()
+
+
+class ProcessDetector:
+
+    def __init__(self, num_workers=2):
+        # fork is not safe with the Qt and pylon threads of the main process
+        context = multiprocessing.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.workers = [context.Process(target=detector_worker,
+                                        args=(self.tasks, self.results),
+                                        daemon=True)
+                        for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.idle_workers = threading.Semaphore(num_workers)
+        self.lock = threading.Lock()
+        self.buffers = []
+        self.free_buffers = deque()
+        self.task_id = 0
+        self.running_tasks = {}
+
+    def wait_for_worker(self, timeout):
+        return self.idle_workers.acquire(timeout=timeout)
+
+    def worker_done(self):
+        self.idle_workers.release()
+
+    def get_buffer(self, size):
+        with self.lock:
+            if len(self.free_buffers) > 0:
+                buffer = self.free_buffers.popleft()
+                if buffer.size >= size:
+                    return buffer
+                self.buffers.remove(buffer)
+                buffer.close()
+                buffer.unlink()
+            buffer = shared_memory.SharedMemory(create=True, size=size)
+            self.buffers.append(buffer)
+            return buffer
+
+    def submit(self, clients, imgs):
+        frames = []
+        buffers = []
+        for img in imgs:
+            buffer = self.get_buffer(img.nbytes)
+            np.copyto(np.ndarray(img.shape, np.uint8,
+                                 buffer=buffer.buf), img)
+            frames.append((buffer.name, img.shape))
+            buffers.append(buffer)
+        with self.lock:
+            self.task_id += 1
+            self.running_tasks[self.task_id] = (clients, buffers)
+        self.tasks.put((self.task_id, frames))
+
+    def get_result(self):
+        result = self.results.get()
+        if result is None:
+            return None
+        task_id, faces, detection_time, times = result
+        with self.lock:
+            clients, buffers = self.running_tasks.pop(task_id)
+            self.free_buffers.extend(buffers)
+        return clients, faces, detection_time, times
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        # wakes up whoever is waiting in get_result
+        self.results.put(None)
+        with self.lock:
+            for buffer in self.buffers:
+                buffer.close()
+                buffer.unlink()
+            self.buffers = []
+            self.free_buffers.clear()
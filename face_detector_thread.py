@@ -1,42 +1,47 @@
 import numpy as np
-from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-import time
-from face_finder import find_faces, net
+from detector_loop import DetectorLoop
 
 
-class FaceDetectorThread(QObject):
+class DetectorClient(QObject):
 
     found_face = pyqtSignal(np.ndarray)
 
-    fps = 0.1
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        client.found_face.connect(self.found_face.emit)
+
+    def send_frame(self, slot):
+        self.client.send_frame(slot)
+
+    def request_detection(self):
+        self.client.request_detection()
+
+
+class FaceDetectorThread(QObject):
 
+    found_face = pyqtSignal(np.ndarray)
+    detection_latency = pyqtSignal(float)
+
+    # the detector loop for the GUI, see GrabThread
     def __init__(self):
         super().__init__()
-        self.running = True
-        self.frame = None
+        self.loop = DetectorLoop()
+        self.loop.found_face.connect(self.found_face.emit)
+        self.loop.detection_latency.connect(self.detection_latency.emit)
 
-    def stop(self):
-        self.running = False
+    def add_client(self):
+        return DetectorClient(self.loop.add_client())
 
-    def send_frame(self, frame):
-        self.frame = frame
-        self.new_frame = True
+    def send_frame(self, slot):
+        self.loop.send_frame(slot)
+
+    def request_detection(self):
+        self.loop.request_detection()
 
     def run(self):
-        while self.running:
-            if not self.frame is None and self.new_frame:
-                self.new_frame = False
-                start_time = time.process_time()
-                self.faces = find_faces(self.frame, net)
-                if len(self.faces) > 0:
-                    face = np.array(self.faces[0][1:5])
-                    self.found_face.emit(face)
-
-                end_time = time.process_time()
-                elapsed_time = end_time - start_time
-            else:
-                elapsed_time = 0
-            # sleep the rest of the time
-            time.sleep(max(1/self.fps - elapsed_time, 0))
+        self.loop.run()
+
+    def stop(self):
+        self.loop.stop()
@@ -1,32 +1,238 @@
+import os
+import time
 import cv2
 import numpy as np
+import settings
+import metrics
 
-net = cv2.dnn.readNetFromTensorflow(
-    'opencv_face_detector_uint8.pb', 'opencv_face_detector.pbtxt')
-
-
-def find_faces(img, net, confidence=0.7):
-    (h, w) = img.shape[:2]
-    blob = cv2.dnn.blobFromImage(img, 1.0, (300, 300))
-    faces = []
-
-    net.setInput(blob)
-    detections = net.forward()
-
-    for i in range(0, detections.shape[2]):
-        # extract the confidence (i.e., probability) associated with the
-        # prediction
-        conf = detections[0, 0, i, 2]
-        # filter out weak detections by ensuring the `confidence` is
-        # greater than the minimum confidence
-        if conf < confidence:
-            continue
-        # compute the (x, y)-coordinates of the bounding box for the
-        # object
-        box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-        (startX, startY, endX, endY) = box.astype("int")
-        faces.append((conf, startX, startY, endX, endY))
-    return faces
+BACKENDS = {
+    "default": cv2.dnn.DNN_BACKEND_DEFAULT,
+    "opencv": cv2.dnn.DNN_BACKEND_OPENCV,
+    "openvino": cv2.dnn.DNN_BACKEND_INFERENCE_ENGINE,
+    "cuda": cv2.dnn.DNN_BACKEND_CUDA,
+}
+
+TARGETS = {
+    "cpu": cv2.dnn.DNN_TARGET_CPU,
+    "opencl": cv2.dnn.DNN_TARGET_OPENCL,
+    "opencl_fp16": cv2.dnn.DNN_TARGET_OPENCL_FP16,
+    "cuda": cv2.dnn.DNN_TARGET_CUDA,
+    "cuda_fp16": cv2.dnn.DNN_TARGET_CUDA_FP16,
+}
+
+stage_times = {stage: metrics.histogram("detector_stage_seconds", stage=stage)
+               for stage in ["blob", "forward", "postprocess"]}
+
+
+def to_faces(confidences, boxes):
+    # best face first, plain python values so the faces can be sent to
+    # other processes and drawn with cv2
+    order = np.argsort(-confidences)
+    return list(zip(confidences[order].tolist(),
+                    *boxes[order].astype(int).T.tolist()))
+
+
+class SsdDetector:
+
+    default_input_size = (300, 300)
+
+    def __init__(self, input_size=None, backend="default", target="cpu",
+                 confidence=0.7, model=None):
+        self.input_size = tuple(input_size or self.default_input_size)
+        self.confidence = confidence
+        self.net = self.load(model)
+        self.net.setPreferableBackend(BACKENDS[backend])
+        self.net.setPreferableTarget(TARGETS[target])
+
+    def load(self, model):
+        return cv2.dnn.readNetFromTensorflow(
+            model or 'opencv_face_detector_uint8.pb', 'opencv_face_detector.pbtxt')
+
+    def warm_up(self):
+        # the first passes allocate and tune, keep them out of the first
+        # real detection
+        img = np.zeros((self.input_size[1], self.input_size[0], 3), np.uint8)
+        for _ in range(2):
+            self.detect(img)
+
+    def forward(self, img, size):
+        start_time = time.perf_counter()
+        blob = cv2.dnn.blobFromImage(img, 1.0, size)
+        blob_time = time.perf_counter()
+        stage_times["blob"].observe(blob_time - start_time)
+        self.net.setInput(blob)
+        # every detection is [image, class, confidence, x0, y0, x1, y1]
+        detections = self.net.forward()[0, 0]
+        forward_time = time.perf_counter()
+        stage_times["forward"].observe(forward_time - blob_time)
+        return detections[detections[:, 2] >= self.confidence], forward_time
+
+    def detect(self, img):
+        (h, w) = img.shape[:2]
+        detections, forward_time = self.forward(img, self.input_size)
+        boxes = detections[:, 3:7] * np.array([w, h, w, h])
+        faces = to_faces(detections[:, 2], boxes)
+        stage_times["postprocess"].observe(time.perf_counter() - forward_time)
+        return faces
+
+    def detect_batch(self, imgs):
+        if len(imgs) == 1:
+            return [self.detect(imgs[0])]
+        # the network can't take a batch, so the images are tiled into one
+        # mosaic and detected in a single forward pass
+        (tile_w, tile_h) = self.input_size
+        cols = int(np.ceil(np.sqrt(len(imgs))))
+        rows = int(np.ceil(len(imgs) / cols))
+        mosaic = np.zeros((rows * tile_h, cols * tile_w, 3), np.uint8)
+        for i, img in enumerate(imgs):
+            row, col = divmod(i, cols)
+            cv2.resize(img, (tile_w, tile_h),
+                       dst=mosaic[row * tile_h:(row + 1) * tile_h,
+                                  col * tile_w:(col + 1) * tile_w])
+        detections, forward_time = self.forward(
+            mosaic, (cols * tile_w, rows * tile_h))
+
+        # the box center decides which tile a detection belongs to
+        boxes = detections[:, 3:7] * np.array([cols, rows, cols, rows])
+        tile_cols = np.floor((boxes[:, 0] + boxes[:, 2]) / 2).astype(int)
+        tile_rows = np.floor((boxes[:, 1] + boxes[:, 3]) / 2).astype(int)
+        tiles = tile_rows * cols + tile_cols
+        boxes = boxes - np.stack([tile_cols, tile_rows, tile_cols, tile_rows], 1)
+        boxes = np.clip(boxes, 0, 1)
+
+        faces = []
+        for i, img in enumerate(imgs):
+            (h, w) = img.shape[:2]
+            mask = (tiles == i) & (tile_cols >= 0) & (tile_cols < cols)
+            faces.append(to_faces(detections[mask, 2],
+                                  boxes[mask] * np.array([w, h, w, h])))
+        stage_times["postprocess"].observe(time.perf_counter() - forward_time)
+        return faces
+
+
+class OnnxDetector(SsdDetector):
+
+    # any ONNX export of an SSD style detector with the same output layout
+    def load(self, model):
+        if model is None:
+            raise ValueError("The onnx detector needs a detector_model")
+        return cv2.dnn.readNetFromONNX(model)
+
+
+class YuNetDetector:
+
+    default_input_size = (320, 320)
+
+    def __init__(self, input_size=None, backend="default", target="cpu",
+                 confidence=0.7, model=None):
+        if not hasattr(cv2, "FaceDetectorYN"):
+            raise ValueError("YuNet needs OpenCV 4.5.4 or newer")
+        self.input_size = tuple(input_size or self.default_input_size)
+        self.net = cv2.FaceDetectorYN.create(
+            model or "face_detection_yunet_2023mar.onnx", "", self.input_size,
+            confidence, 0.3, 5000, BACKENDS[backend], TARGETS[target])
+        self.img = np.empty((self.input_size[1], self.input_size[0], 3), np.uint8)
+
+    def warm_up(self):
+        for _ in range(2):
+            self.detect(self.img)
+
+    def detect(self, img):
+        (h, w) = img.shape[:2]
+        start_time = time.perf_counter()
+        cv2.resize(img, self.input_size, dst=self.img)
+        # every face is x, y, width, height, five landmarks and the score
+        detections = self.net.detect(self.img)[1]
+        forward_time = time.perf_counter()
+        stage_times["forward"].observe(forward_time - start_time)
+        if detections is None:
+            return []
+        boxes = detections[:, 0:4].copy()
+        boxes[:, 2:4] += boxes[:, 0:2]
+        boxes *= np.array([w, h, w, h]) / np.array(self.input_size * 2)
+        faces = to_faces(detections[:, 14], boxes)
+        stage_times["postprocess"].observe(time.perf_counter() - forward_time)
+        return faces
+
+    def detect_batch(self, imgs):
+        return [self.detect(img) for img in imgs]
+
+
+class HaarDetector:
+
+    default_input_size = (320, 180)
+
+    def __init__(self, input_size=None, backend="default", target="cpu",
+                 confidence=0.7, model=None):
+        # the image is scaled to the width of the input size, the height
+        # follows the aspect ratio
+        self.input_size = tuple(input_size or self.default_input_size)
+        self.cascade = cv2.CascadeClassifier(model or os.path.join(
+            cv2.data.haarcascades, "haarcascade_frontalface_default.xml"))
+
+    def warm_up(self):
+        pass
+
+    def detect(self, img):
+        (h, w) = img.shape[:2]
+        start_time = time.perf_counter()
+        scale = self.input_size[0] / w
+        gray = cv2.cvtColor(cv2.resize(img, None, fx=scale, fy=scale),
+                            cv2.COLOR_BGR2GRAY)
+        detections = self.cascade.detectMultiScale(gray, 1.1, 5)
+        forward_time = time.perf_counter()
+        stage_times["forward"].observe(forward_time - start_time)
+        if len(detections) == 0:
+            return []
+        boxes = np.asarray(detections, np.float64)
+        boxes[:, 2:4] += boxes[:, 0:2]
+        # the cascade has no score, larger faces go first
+        faces = to_faces(boxes[:, 2] - boxes[:, 0], boxes / scale)
+        faces = [(1.0,) + face[1:] for face in faces]
+        stage_times["postprocess"].observe(time.perf_counter() - forward_time)
+        return faces
+
+    def detect_batch(self, imgs):
+        return [self.detect(img) for img in imgs]
+
+
+DETECTORS = {
+    "ssd": SsdDetector,
+    "onnx": OnnxDetector,
+    "yunet": YuNetDetector,
+    "haar": HaarDetector,
+}
+
+
+def create_detector(name, input_size=None, backend="default", target="cpu",
+                    confidence=0.7, model=None, threads=None):
+    if not name in DETECTORS:
+        raise ValueError(f"Unknown face detector '{name}'")
+    if not threads is None:
+        # OpenCV's thread pool is shared by the whole process
+        cv2.setNumThreads(threads)
+    return DETECTORS[name](input_size, backend, target, confidence, model)
+
+
+# parsed and warmed up detectors, a restarted detector thread or a
+# setting that is changed back doesn't load the model again
+loaded_detectors = {}
+
+
+def load_detector():
+    input_size = settings.get_setting("detector_input_size", None)
+    options = (settings.get_setting("detector", "ssd"),
+               None if input_size is None else tuple(input_size),
+               settings.get_setting("detector_backend", "default"),
+               settings.get_setting("detector_target", "cpu"),
+               settings.get_setting("detector_confidence", 0.7),
+               settings.get_setting("detector_model", None),
+               settings.get_setting("detector_threads", None))
+    if not options in loaded_detectors:
+        detector = create_detector(*options)
+        detector.warm_up()
+        loaded_detectors[options] = detector
+    return loaded_detectors[options]
 
 
 def draw_face_box(img, face):
@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+
+class FaceTracker:
+
+    def __init__(self, width=320, max_points=50, min_points=6, max_error=1.0):
+        self.width = width
+        self.max_points = max_points
+        self.min_points = min_points
+        self.max_error = max_error
+        self.scale = None
+        self.small = None
+        self.gray = None
+        self.prev_gray = None
+        self.mask = None
+        self.points = None
+        self.box = None
+
+    def is_tracking(self):
+        return not self.box is None
+
+    def prepare(self, frame):
+        (h, w) = frame.shape[:2]
+        height = int(round(h * self.width / w))
+        if self.small is None or self.scale != w / self.width:
+            self.scale = w / self.width
+            self.small = np.empty((height, self.width, 3), np.uint8)
+            self.gray = np.empty((height, self.width), np.uint8)
+            self.prev_gray = np.empty((height, self.width), np.uint8)
+            self.mask = np.zeros((height, self.width), np.uint8)
+        cv2.resize(frame, (self.width, height), dst=self.small,
+                   interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+    def start(self, frame, face):
+        self.prepare(frame)
+        self.gray, self.prev_gray = self.prev_gray, self.gray
+        self.box = np.array(face[0:4], np.float32) / self.scale
+        self.points = self.find_points()
+        if self.points is None or len(self.points) < self.min_points:
+            self.stop()
+            return False
+        return True
+
+    def find_points(self):
+        startX, startY, endX, endY = self.box.astype(int)
+        self.mask.fill(0)
+        self.mask[max(startY, 0):max(endY, 0), max(startX, 0):max(endX, 0)] = 255
+        return cv2.goodFeaturesToTrack(
+            self.prev_gray, self.max_points, 0.01, 3, mask=self.mask)
+
+    def stop(self):
+        self.points = None
+        self.box = None
+
+    def update(self, frame):
+        if self.box is None:
+            return None
+        self.prepare(frame)
+        points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.prev_gray, self.gray, self.points, None,
+            winSize=(15, 15), maxLevel=2)
+        # only keep points that flow back to where they started
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(
+            self.gray, self.prev_gray, points, None,
+            winSize=(15, 15), maxLevel=2)
+        error = np.abs(back_points - self.points).reshape(-1, 2).max(axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & \
+            (error < self.max_error)
+        self.gray, self.prev_gray = self.prev_gray, self.gray
+        if np.count_nonzero(good) < self.min_points:
+            self.stop()
+            return None
+
+        old = self.points[good].reshape(-1, 2)
+        new = points[good].reshape(-1, 2)
+        shift = np.median(new - old, axis=0)
+        # scale change from the spread of the points around their center
+        old_spread = np.median(np.linalg.norm(old - old.mean(axis=0), axis=1))
+        new_spread = np.median(np.linalg.norm(new - new.mean(axis=0), axis=1))
+        zoom = new_spread / old_spread if old_spread > 0 else 1
+        zoom = min(max(zoom, 0.9), 1.1)
+
+        center = (self.box[0:2] + self.box[2:4]) / 2 + shift
+        half_size = (self.box[2:4] - self.box[0:2]) / 2 * zoom
+        self.box = np.concatenate([center - half_size, center + half_size])
+        self.points = new.reshape(-1, 1, 2)
+
+        (h, w) = self.gray.shape
+        if self.box[2] < 0 or self.box[3] < 0 or self.box[0] > w or self.box[1] > h:
+            self.stop()
+            return None
+        if len(self.points) < self.max_points // 2:
+            points = self.find_points()
+            if not points is None and len(points) > len(self.points):
+                self.points = points
+        return (self.box * self.scale).astype(int)
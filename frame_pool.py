@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+class FrameSlot:
+
+    def __init__(self, pool, index, shape, dtype):
+        self.pool = pool
+        self.index = index
+        self.buffer = np.empty(shape, dtype)
+        # the frame may be a view that does not live in our own buffer,
+        # e.g. a memory mapped recording
+        self.array = self.buffer
+        self.seq = 0
+        self.timestamp = 0
+        self.ref_count = 0
+
+    def retain(self, count=1):
+        self.pool.retain(self, count)
+
+    def release(self):
+        self.pool.release(self)
+
+
+class FramePool:
+
+    def __init__(self, num_slots, shape, dtype=np.uint8):
+        self.lock = threading.Lock()
+        self.slots = [FrameSlot(self, i, shape, dtype)
+                      for i in range(num_slots)]
+        # hand out the least recently released slot first, so a buffer is
+        # reused as late as possible
+        self.free = deque(self.slots)
+        self.seq = 0
+        self.num_exhausted = 0
+
+    def acquire(self):
+        with self.lock:
+            if len(self.free) == 0:
+                self.num_exhausted += 1
+                return None
+            slot = self.free.popleft()
+            slot.ref_count = 1
+            self.seq += 1
+            slot.seq = self.seq
+        slot.timestamp = time.perf_counter()
+        return slot
+
+    def retain(self, slot, count=1):
+        with self.lock:
+            slot.ref_count += count
+
+    def release(self, slot):
+        with self.lock:
+            slot.ref_count -= 1
+            if slot.ref_count == 0:
+                slot.array = slot.buffer
+                self.free.append(slot)
+            elif slot.ref_count < 0:
+                raise RuntimeError(f"Frame slot {slot.index} released too often")
+
+    def num_free(self):
+        with self.lock:
+            return len(self.free)
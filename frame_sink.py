@@ -0,0 +1,144 @@
+import time
+from collections import deque
+import numpy as np
+import cv2
+import pyvirtualcam
+
+
+class YuvConverter:
+
+    def __init__(self, width, height, output_format):
+        self.width = width
+        self.height = height
+        self.output_format = output_format
+        # I420 and NV12 share the full size Y plane, only the chroma
+        # planes are laid out differently
+        self.yuv = np.empty((height * 3 // 2, width), np.uint8)
+        self.uv = None
+        if output_format == "NV12":
+            self.uv = np.empty((height // 2, width // 2, 2), np.uint8)
+
+    def convert(self, frame):
+        cv2.cvtColor(frame, cv2.COLOR_BGR2YUV_I420, dst=self.yuv)
+        if not self.uv is None:
+            chroma = self.yuv[self.height:].reshape(2, self.height // 2, self.width // 2)
+            self.uv[..., 0] = chroma[0]
+            self.uv[..., 1] = chroma[1]
+            self.yuv[self.height:] = self.uv.reshape(self.height // 2, self.width)
+        return self.yuv
+
+
+class FpsCounter:
+
+    def __init__(self, num_frames=30):
+        self.times = deque(maxlen=num_frames)
+
+    def tick(self):
+        self.times.append(time.perf_counter())
+
+    @property
+    def avg_fps(self):
+        if len(self.times) < 2:
+            return 0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+class VirtualCamSink:
+
+    def __init__(self, width, height, fps, device=None, output_format="BGR"):
+        self.fps = fps
+        self.virt_cam = pyvirtualcam.Camera(width=width,
+                                            height=height,
+                                            fps=fps, device=device,
+                                            print_fps=False,
+                                            fmt=pyvirtualcam.PixelFormat[output_format])
+
+    @property
+    def avg_fps(self):
+        return self.virt_cam._fps_counter.avg_fps
+
+    def send(self, frame):
+        self.virt_cam.send(frame)
+
+    def sleep_until_next_frame(self):
+        self.virt_cam.sleep_until_next_frame()
+
+    def close(self):
+        self.virt_cam.close()
+
+
+class NullSink:
+
+    def __init__(self, width, height, fps, paced=True):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.paced = paced
+        self.fps_counter = FpsCounter()
+        self.next_frame_time = time.perf_counter()
+
+    @property
+    def avg_fps(self):
+        return self.fps_counter.avg_fps
+
+    def send(self, frame):
+        self.fps_counter.tick()
+
+    def sleep_until_next_frame(self):
+        if not self.paced:
+            return
+        self.next_frame_time += 1 / self.fps
+        delay = self.next_frame_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # we are late, don't try to catch up with a burst of frames
+            self.next_frame_time = time.perf_counter()
+
+    def close(self):
+        pass
+
+
+class CountingSink(NullSink):
+
+    def __init__(self, width, height, fps, paced=True):
+        super().__init__(width, height, fps, paced)
+        self.num_frames = 0
+        self.num_bytes = 0
+        self.first_frame_time = None
+        self.last_frame_time = None
+        self.max_interval = 0
+
+    def send(self, frame):
+        super().send(frame)
+        now = time.perf_counter()
+        if self.first_frame_time is None:
+            self.first_frame_time = now
+        else:
+            self.max_interval = max(self.max_interval,
+                                    now - self.last_frame_time)
+        self.last_frame_time = now
+        self.num_frames += 1
+        self.num_bytes += frame.nbytes
+
+    def stats(self):
+        duration = 0
+        if self.first_frame_time is not None:
+            duration = self.last_frame_time - self.first_frame_time
+        return {
+            "frames": self.num_frames,
+            "bytes": self.num_bytes,
+            "duration": duration,
+            "fps": (self.num_frames - 1) / duration if duration > 0 else 0,
+            "max_interval": self.max_interval,
+        }
+
+
+def create_sink(name, width, height, fps, device=None, output_format="BGR"):
+    if name == "virtualcam":
+        return VirtualCamSink(width, height, fps, device, output_format)
+    elif name == "null":
+        return NullSink(width, height, fps)
+    elif name == "counting":
+        return CountingSink(width, height, fps)
+    raise ValueError(f"Unknown frame sink '{name}'")
@@ -0,0 +1,386 @@
+import os
+import threading
+import time
+import numpy as np
+import cv2
+from pypylon import pylon, genicam
+import settings
+from camera_nodes import is_writable, set_int_value
+from resolution_planner import plan_resolution
+from demosaic import Demosaicer
+from raw_capture import ReplaySource
+
+
+GRAB_STRATEGIES = {
+    "OneByOne": pylon.GrabStrategy_OneByOne,
+    "LatestImageOnly": pylon.GrabStrategy_LatestImageOnly,
+    "LatestImages": pylon.GrabStrategy_LatestImages,
+    "UpcomingImage": pylon.GrabStrategy_UpcomingImage,
+}
+
+
+class FrameHandler(pylon.ImageEventHandler):
+
+    def __init__(self, source):
+        super().__init__()
+        self.source = source
+        self.condition = threading.Condition()
+        # the buffer a waiting grab_into wants the next frame in
+        self.target = None
+        self.target_filled = False
+        # frames that arrive while nobody waits end up here
+        self.spare = None
+        self.spare_ready = False
+        self.spare_time = 0
+        self.num_dropped = 0
+
+    def OnImageGrabbed(self, camera, grabResult):
+        # runs in pylon's grab loop thread, the result is only valid
+        # until we return
+        now = time.perf_counter()
+        if not grabResult.GrabSucceeded():
+            return
+        self.source.num_skipped += grabResult.GetNumberOfSkippedImages()
+        with self.condition:
+            if not self.target is None and not self.target_filled:
+                self.source.convert(grabResult.Array, self.target)
+                self.target_filled = True
+                self.source.frame_time = now
+                self.condition.notify()
+            else:
+                if self.spare is None:
+                    self.spare = np.empty_like(grabResult.Array)
+                if self.spare_ready:
+                    self.num_dropped += 1
+                np.copyto(self.spare, grabResult.Array)
+                self.spare_ready = True
+                self.spare_time = now
+
+    def wait_into(self, out, timeout):
+        with self.condition:
+            if self.spare_ready:
+                # the grab loop was late, take the newest frame we kept
+                self.spare_ready = False
+                self.source.frame_time = self.spare_time
+                return self.source.convert(self.spare, out)
+            self.target = out
+            self.target_filled = False
+            self.condition.wait_for(lambda: self.target_filled, timeout)
+            filled = self.target_filled
+            self.target = None
+            self.target_filled = False
+        if filled:
+            return out
+        return None
+
+    def clear(self):
+        with self.condition:
+            # grabbing starts again, maybe with another size or format
+            self.spare = None
+            self.spare_ready = False
+
+
+class PylonSource:
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.demosaicer = None
+        self.handler = None
+        self.paced = False
+        self.pixel_format = "BGR8"
+        # the Bayer frame as the camera delivered it, only kept for raw
+        # captures
+        self.keep_raw = False
+        self.raw = None
+        self.frame_time = 0
+        # frames the camera delivered but the grab strategy dropped
+        self.num_skipped = 0
+        self.serial = camera.GetDeviceInfo().GetSerialNumber()
+        # the node map after configure, loaded again after a reconnect
+        self.features = None
+        self.restore_features()
+
+    @property
+    def width(self):
+        return self.camera.Width.Value
+
+    @property
+    def height(self):
+        return self.camera.Height.Value
+
+    def configure(self, input_res, output_res, fps):
+        pixel_format = settings.get_setting("pixel_format", "BGR8")
+        self.pixel_format = "BGR8"
+        if pixel_format.startswith("Bayer"):
+            self.pixel_format = pixel_format
+            # a third of the bytes over USB, the color is interpolated on
+            # the host
+            self.camera.PixelFormat = pixel_format
+        # emulated devices only know the legacy "BGR8Packed" name
+        elif "BGR8" in self.camera.PixelFormat.Symbolics:
+            self.camera.PixelFormat = "BGR8"
+        else:
+            self.camera.PixelFormat = "BGR8Packed"
+        # let the sensor shrink the image if it can, that saves bandwidth
+        # and most of the resize on the host
+        plan = plan_resolution(self.camera, input_res, output_res)
+        for feature in ["Binning", "Decimation"]:
+            factor = plan[feature.lower()]
+            for direction in ["Horizontal", "Vertical"]:
+                if is_writable(self.camera, feature + direction):
+                    getattr(self.camera, feature + direction).Value = factor
+        set_int_value(self.camera.Width, plan["width"])
+        set_int_value(self.camera.Height, plan["height"])
+        self.camera.AcquisitionFrameRate = fps
+        self.camera.AcquisitionFrameRateEnable = True
+        self.update_settings()
+        self.timeout = 2 / fps
+        self.grab_strategy = GRAB_STRATEGIES[settings.get_setting(
+            "grab_strategy", "LatestImages")]
+        self.num_buffers = settings.get_setting("grab_buffers", 20)
+        # "event" lets pylon's grab loop thread hand us every frame as it
+        # arrives, the camera clock then paces the whole pipeline
+        self.paced = settings.get_setting("grab_mode", "poll") == "event"
+
+        if not self.demosaicer is None:
+            self.demosaicer.close()
+            self.demosaicer = None
+        if pixel_format.startswith("Bayer"):
+            self.demosaicer = Demosaicer(
+                self.width, self.height, pixel_format,
+                settings.get_setting("demosaic_threads", None))
+        self.configuration = (input_res, output_res, fps)
+        self.features = pylon.FeaturePersistence.SaveToString(
+            self.camera.GetNodeMap())
+
+    def snapshot_path(self):
+        directory = settings.get_setting("feature_snapshot_dir", None)
+        if directory is None:
+            return None
+        return os.path.join(os.path.expanduser(directory), self.serial + ".pfs")
+
+    def restore_features(self):
+        # what was set in the last session is loaded in one go, instead of
+        # node by node
+        path = self.snapshot_path()
+        if path is None or not os.path.exists(path):
+            return
+        try:
+            pylon.FeaturePersistence.Load(path, self.camera.GetNodeMap(), True)
+        except genicam.GenericException:
+            # e.g. saved by another firmware version, the camera keeps its
+            # own values
+            pass
+
+    def save_features(self):
+        path = self.snapshot_path()
+        if path is None or self.camera.IsCameraDeviceRemoved():
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        settings.write_atomic(path, pylon.FeaturePersistence.SaveToString(
+            self.camera.GetNodeMap()))
+
+    def reconnect(self):
+        # the device is attached to the same InstantCamera again, everybody
+        # holding the camera keeps a working one
+        self.camera.DestroyDevice()
+        info = pylon.DeviceInfo()
+        info.SetSerialNumber(self.serial)
+        self.camera.Attach(pylon.TlFactory.GetInstance().CreateFirstDevice(info))
+        self.camera.Open()
+        pylon.FeaturePersistence.LoadFromString(
+            self.features, self.camera.GetNodeMap(), True)
+        self.configure(*self.configuration)
+        self.start()
+
+    def update_settings(self):
+        # settings that can be changed while grabbing
+        if is_writable(self.camera, "AutoExposureTimeUpperLimit"):
+            self.camera.AutoExposureTimeUpperLimit = settings.get_setting(
+                "max_exposure_time", 15000)
+
+    def start(self):
+        self.camera.MaxNumBuffer = self.num_buffers
+        if self.paced:
+            if self.handler is None:
+                self.handler = FrameHandler(self)
+                self.camera.RegisterImageEventHandler(
+                    self.handler, pylon.RegistrationMode_ReplaceAll,
+                    pylon.Cleanup_None)
+            self.handler.clear()
+            self.camera.StartGrabbing(self.grab_strategy,
+                                      pylon.GrabLoop_ProvidedByInstantCamera)
+        else:
+            self.camera.StartGrabbingMax(1_000_000_000, self.grab_strategy)
+
+    def stop(self):
+        self.camera.StopGrabbing()
+
+    def convert(self, raw, out):
+        # copy once, the grab buffer goes back to pylon right away
+        if self.demosaicer is None:
+            np.copyto(out, raw)
+            return out
+        if self.keep_raw:
+            if self.raw is None or self.raw.shape != raw.shape or \
+                    self.raw.dtype != raw.dtype:
+                self.raw = np.empty_like(raw)
+            np.copyto(self.raw, raw)
+        return self.demosaicer.convert(raw, out)
+
+    def grab_into(self, out):
+        if self.paced:
+            # a frame that doesn't arrive in time is resent by the grab loop
+            frame = self.handler.wait_into(out, self.timeout)
+        else:
+            frame = self.retrieve_into(out)
+        if frame is None and self.camera.IsCameraDeviceRemoved():
+            # the grab loop reconnects on this
+            raise genicam.RuntimeException("The camera was removed")
+        return frame
+
+    def retrieve_into(self, out):
+        frame = None
+        grabResult = self.camera.RetrieveResult(
+            5000, pylon.TimeoutHandling_Return)
+        # Image grabbed successfully?
+        if grabResult.GrabSucceeded():
+            self.frame_time = time.perf_counter()
+            self.num_skipped += grabResult.GetNumberOfSkippedImages()
+            frame = self.convert(grabResult.Array, out)
+        grabResult.Release()
+        return frame
+
+    def counters(self):
+        # exported by the grab thread, with the labels of its camera
+        values = {"frames_skipped_total": self.num_skipped}
+        if not self.handler is None:
+            values["frames_dropped_total"] = self.handler.num_dropped
+        return values
+
+    def close(self):
+        try:
+            self.save_features()
+        except (genicam.GenericException, OSError):
+            # the next session starts from the camera's own values
+            pass
+        if not self.demosaicer is None:
+            self.demosaicer.close()
+            self.demosaicer = None
+        if not self.handler is None:
+            self.camera.DeregisterImageEventHandler(self.handler)
+            self.handler = None
+        self.camera.Close()
+
+
+class SyntheticSource:
+
+    camera = None
+    paced = False
+    pixel_format = "BGR8"
+    keep_raw = False
+
+    def __init__(self, width=1920, height=1080, face_image=None):
+        self.width = width
+        self.height = height
+        self.face_image = face_image
+        self.frame_num = 0
+        self.frame_time = 0
+
+    def configure(self, input_res, output_res, fps):
+        self.width = input_res[0]
+        self.height = input_res[1]
+        self.background = make_background(self.width, self.height)
+        self.face = None
+        if self.face_image is not None:
+            self.face = cv2.imread(self.face_image)
+
+    def start(self):
+        self.frame_num = 0
+
+    def stop(self):
+        pass
+
+    def update_settings(self):
+        pass
+
+    def grab_into(self, out):
+        self.frame_time = time.perf_counter()
+        np.copyto(out, self.background)
+        face_size = self.height // 3
+        # walk the face along a lissajous path so trackers have to follow
+        t = self.frame_num / 60
+        center_x = int(self.width / 2 + np.sin(t) * (self.width - face_size) / 3)
+        center_y = int(self.height / 2 + np.sin(2 * t) * (self.height - face_size) / 4)
+        if self.face is None:
+            draw_synthetic_face(out, center_x, center_y, face_size)
+        else:
+            paste_face(out, self.face, center_x, center_y, face_size)
+        self.frame_num += 1
+        return out
+
+    def close(self):
+        pass
+
+
+def make_background(width, height):
+    gradient_x = np.linspace(40, 200, width, dtype=np.float32)
+    gradient_y = np.linspace(0, 40, height, dtype=np.float32)
+    gray = (gradient_y[:, None] + gradient_x[None, :]).astype(np.uint8)
+    return cv2.merge([gray, gray, gray])
+
+
+def draw_synthetic_face(img, center_x, center_y, size):
+    axes = (size // 3, size // 2 - 10)
+    cv2.ellipse(img, (center_x, center_y), axes,
+                0, 0, 360, (140, 170, 220), -1)
+    eye_y = center_y - size // 8
+    eye_dx = size // 8
+    eye_r = max(size // 24, 2)
+    cv2.circle(img, (center_x - eye_dx, eye_y), eye_r, (40, 40, 40), -1)
+    cv2.circle(img, (center_x + eye_dx, eye_y), eye_r, (40, 40, 40), -1)
+    cv2.ellipse(img, (center_x, center_y + size // 6), (size // 8, size // 24),
+                0, 0, 180, (60, 60, 150), -1)
+
+
+def paste_face(img, face, center_x, center_y, size):
+    face = cv2.resize(face, (size, size))
+    startX = min(max(center_x - size // 2, 0), img.shape[1] - size)
+    startY = min(max(center_y - size // 2, 0), img.shape[0] - size)
+    img[startY:startY + size, startX:startX + size] = face
+
+
+def open_camera(serial=None):
+    # the first camera that is found if there is no serial number
+    info = pylon.DeviceInfo()
+    if not serial is None:
+        info.SetSerialNumber(serial)
+    camera = pylon.InstantCamera(
+        pylon.TlFactory.GetInstance().CreateFirstDevice(info))
+    camera.Open()
+    return camera
+
+
+def open_emulated_camera():
+    # the transport layer only lists emulated devices if this is set before
+    # it is first enumerated
+    os.environ.setdefault("PYLON_CAMEMU", "1")
+    info = pylon.DeviceInfo()
+    info.SetDeviceClass("BaslerCamEmu")
+    camera = pylon.InstantCamera(
+        pylon.TlFactory.GetInstance().CreateFirstDevice(info))
+    camera.Open()
+    return camera
+
+
+def create_source(name, camera=None):
+    if name == "synthetic":
+        return SyntheticSource(face_image=settings.get_setting("synthetic_face_image"))
+    elif name == "emulation":
+        return PylonSource(open_emulated_camera())
+    elif name == "pylon":
+        return PylonSource(camera)
+    elif name == "replay":
+        return ReplaySource(settings.get_setting("replay_path"),
+                            settings.get_setting("replay_speed", "original"))
+    raise ValueError(f"Unknown frame source '{name}'")
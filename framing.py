@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class FramingEngine:
+
+    def __init__(self, frame_res, output_res, zoom=None, smoothing=0.3,
+                 max_speed=0.05, dead_zone=0.05):
+        self.frame_res = np.array(frame_res, np.float64)
+        output_res = np.array(output_res, np.float64)
+        if zoom is None:
+            # one sensor pixel per output pixel, the crop is a plain view
+            self.crop_res = np.minimum(output_res, self.frame_res)
+        else:
+            # the largest window with the output's aspect ratio, zoomed in
+            scale = min(self.frame_res / output_res) / max(zoom, 1)
+            self.crop_res = np.floor(output_res * scale)
+        self.crop_res = self.crop_res.astype(int)
+        # per frame, relative to the crop size
+        self.smoothing = smoothing
+        self.max_speed = max_speed * self.crop_res
+        self.dead_zone = dead_zone * self.crop_res
+        self.reset()
+
+    def reset(self):
+        self.center = self.frame_res / 2
+        self.target = self.center.copy()
+
+    def update(self, face):
+        if not face is None:
+            face_center = np.array([(face[0] + face[2]) / 2,
+                                    (face[1] + face[3]) / 2])
+            # only follow movements that leave the dead zone, so the
+            # picture stands still while somebody sits still
+            if np.any(np.abs(face_center - self.target) > self.dead_zone):
+                self.target = face_center
+        step = (self.target - self.center) * self.smoothing
+        step = np.clip(step, -self.max_speed, self.max_speed)
+        self.center = self.center + step
+
+    def crop_rect(self):
+        half = self.crop_res / 2
+        start = np.clip(self.center - half, 0, self.frame_res - self.crop_res)
+        startX, startY = start.astype(int)
+        return startX, startY, startX + self.crop_res[0], startY + self.crop_res[1]
@@ -0,0 +1,600 @@
+import numpy as np
+from pypylon import genicam
+import time
+import threading
+import settings
+import metrics
+from callbacks import Callbacks
+from frame_source import PylonSource
+from camera_nodes import CommandQueue, NodeCache, is_writable
+from frame_sink import create_sink
+from frame_pool import FramePool
+from recorder import Recorder, RecordingSink
+from raw_capture import CaptureWriter
+from shared_frames import SharedFramePublisher
+from face_tracker import FaceTracker
+from framing import FramingEngine
+from stages import COLOR_SETTINGS, DEFAULT_STAGES, StagePipeline, create_stages
+
+
+STEERING_NODES = [
+    "Width", "Height", "OffsetX", "OffsetY",
+    "AutoFunctionROIWidth", "AutoFunctionROIHeight",
+    "AutoFunctionROIOffsetX", "AutoFunctionROIOffsetY",
+]
+
+
+# changing these needs new buffers and a new sink, grabbing is restarted
+RESTART_SETTINGS = {
+    "input_resolution", "output_resolution", "fps", "sink",
+    "framing", "framing_zoom", "resize_interpolation", "frame_pool_size",
+    "pixel_format", "demosaic_threads", "output_format",
+    "grab_mode", "grab_strategy", "grab_buffers",
+    "stages", "stage_workers", "stage_max_in_flight",
+}
+
+# the outputs next to the virtual camera, they are replaced between two
+# frames, the source and the sink keep running
+OUTPUT_SETTINGS = {
+    "recording": {"record_path", "record_codec", "record_queue_size",
+                  "record_drop_policy"},
+    "capture": {"capture_path", "record_queue_size", "record_drop_policy"},
+    "publisher": {"shm_name", "shm_slots"},
+}
+
+
+class GrabLoop:
+
+    vga_resolution = (854, 480)
+
+    def __init__(self, name="main"):
+        self.running = True
+        # every camera has its own metrics, told apart by this label
+        self.labels = {"camera": name}
+        self.camera = None
+        self.source = None
+        self.sink = None
+        self.preview_enabled = False
+        # the face the frames are framed and exposed for, the last
+        # detection or the box of the tracker, only used by the grab loop
+        self.face = None
+        # the last detection with its id, set in one go by the detector
+        self.detection = (0, None)
+        # the id of the detection the grab loop used last
+        self.last_face_id = 0
+        self.frame_consumers = 0
+        self.slot = None
+        self.frame_pool = None
+        self.pipeline = None
+        self.nodes = None
+        self.tracker = FaceTracker()
+        self.commands = CommandQueue(labels=self.labels)
+        # while the camera is lost, the next time we try to open it again
+        self.reconnect_time = None
+        self.reconnect_delay = 0
+        # opens the camera again next to the grab loop
+        self.reconnector = None
+        self.reconnect_succeeded = False
+        # close the recordings that were detached, they may still have
+        # frames to write
+        self.output_closers = []
+        self.capture = None
+        self.publisher = None
+        self.avg_fps = Callbacks()
+        self.frame_grabbed = Callbacks()
+        self.face_tracked = Callbacks()
+        self.track_lost = Callbacks()
+        # the camera came back after it was lost, its features are new objects
+        self.reconnected = Callbacks()
+        self.finished = Callbacks()
+        self.changed_settings = set()
+        self.settings_lock = threading.Lock()
+        settings.add_listener(self.settings_changed)
+        self.stage_times = {stage: metrics.histogram(
+            "grab_stage_seconds", stage=stage, **self.labels)
+            for stage in ["retrieve", "process", "send", "emit", "track",
+                          "camera", "sleep"]}
+        self.frame_time = metrics.histogram("grab_frame_seconds", **self.labels)
+        # the last frame is sent again when no new one could be grabbed
+        self.duplicated_frames = metrics.counter(
+            "frames_duplicated_total", **self.labels)
+        # from the arrival of a frame until it went to the sink
+        self.frame_age = metrics.histogram("frame_age_seconds", **self.labels)
+        self.lost_cameras = metrics.counter("camera_lost_total", **self.labels)
+        self.reconnect_attempts = metrics.counter(
+            "camera_reconnect_attempts_total", **self.labels)
+        self.failed_writes = metrics.counter(
+            "camera_steering_failed_total", **self.labels)
+        metrics.add_collector(self.collect_metrics, **self.labels)
+
+    def stop(self):
+        self.running = False
+
+    def add_frame_consumer(self, callback):
+        # every consumer gets a reference to each emitted frame slot and has
+        # to release it once it is done with it
+        self.frame_grabbed.connect(callback)
+        self.frame_consumers += 1
+
+    def set_camera(self, camera):
+        self.set_source(PylonSource(camera))
+
+    def set_source(self, source, sink_name=None, sink_device=None):
+        # writes queued for the previous camera don't apply to this one
+        self.commands.clear()
+        self.source = source
+        self.sink_name = sink_name
+        self.sink_device = sink_device
+        self.configure()
+
+    def configure(self):
+        with self.settings_lock:
+            self.changed_settings = set()
+        source = self.source
+        self.camera = source.camera
+        if not self.camera is None and not is_writable(self.camera, "AutoFunctionROIWidth"):
+            # e.g. the pylon camera emulation, there is nothing to steer
+            self.camera = None
+        self.nodes = None
+        self.input_res = settings.get_setting(
+            "input_resolution", [source.width, source.height])
+        self.output_res = settings.get_setting(
+            "output_resolution", [source.width, source.height])
+        self.fps = settings.get_setting("fps", 30)
+        self.commands.min_interval = settings.get_setting(
+            "feature_write_interval", 0.05)
+        self.tracking_enabled = settings.get_setting("face_tracking", True)
+        # "digital" crops the output from the full input instead of moving
+        # the sensor offsets, so the sensor must not shrink the input
+        self.framing = None
+        if settings.get_setting("framing", "offset") == "digital":
+            self.source.configure(self.input_res, self.input_res, self.fps)
+            self.framing = FramingEngine([self.source.width, self.source.height],
+                                         self.output_res,
+                                         settings.get_setting("framing_zoom", None))
+            crop_res = list(self.framing.crop_res)
+        else:
+            self.source.configure(self.input_res, self.output_res, self.fps)
+            crop_res = None
+        # YUV halves the bytes per frame and is what the consumers of the
+        # virtual camera work with anyway
+        output_format = settings.get_setting("output_format", "BGR")
+        self.output_format = output_format
+        # with more than one frame in flight the stages of consecutive
+        # frames overlap on a worker pool, the output lags by that many frames
+        max_in_flight = max(settings.get_setting("stage_max_in_flight", 1), 1)
+        self.pipeline = StagePipeline(
+            create_stages(settings.get_setting("stages", DEFAULT_STAGES),
+                          (self.source.height, self.source.width, 3),
+                          self.output_res, output_format,
+                          settings.get_setting("resize_interpolation", "linear"),
+                          crop_res, StagePipeline.depth(max_in_flight)),
+            settings.get_setting("stage_workers", 2), max_in_flight, self.labels)
+        sink_name = self.sink_name
+        if sink_name is None:
+            sink_name = settings.get_setting("sink", "virtualcam")
+        self.sink = create_sink(sink_name, self.output_res[0],
+                                self.output_res[1], self.fps, self.sink_device,
+                                output_format)
+        self.open_outputs()
+        # the grab loop holds one slot and acquires the next, each consumer
+        # holds its latest frame and the one it is working on, the pipeline
+        # holds the frames in flight
+        self.frame_pool = FramePool(
+            max(settings.get_setting("frame_pool_size", 8),
+                2 * self.frame_consumers + 2 + max_in_flight),
+            (self.source.height, self.source.width, 3))
+        self.slot = self.frame_pool.acquire()
+        self.slot.buffer.fill(255)
+        if not self.camera is None:
+            # everything the grab loop reads is read once here, afterwards
+            # only changed values go to the device
+            self.nodes = NodeCache(self.camera)
+            self.nodes.snapshot(STEERING_NODES)
+
+    def settings_changed(self, changed):
+        # applied by the grab loop between two frames
+        with self.settings_lock:
+            self.changed_settings |= changed
+
+    def open_outputs(self, outputs=OUTPUT_SETTINGS.keys()):
+        record_path = settings.get_setting("record_path", None)
+        if "recording" in outputs and not record_path is None:
+            # a background thread writes what the virtual camera gets, when
+            # the disk falls behind frames are dropped from the recording
+            self.sink = RecordingSink(self.sink, Recorder(
+                record_path, self.output_res[0], self.output_res[1], self.fps,
+                self.output_format, settings.get_setting("record_codec", "MJPG"),
+                settings.get_setting("record_queue_size", 60),
+                settings.get_setting("record_drop_policy", "oldest"),
+                self.labels))
+        # other local processes can map the output frames from here
+        shm_name = settings.get_setting("shm_name", None)
+        if "publisher" in outputs and not shm_name is None:
+            self.publisher = SharedFramePublisher(
+                shm_name, self.output_res[0], self.output_res[1],
+                self.output_format, settings.get_setting("shm_slots", 4))
+        # grabbed frames with the face used for them, for exact replays
+        capture_path = settings.get_setting("capture_path", None)
+        if "capture" in outputs and not capture_path is None:
+            self.capture = CaptureWriter(
+                capture_path, self.source.width, self.source.height, self.fps,
+                self.source.pixel_format,
+                queue_size=settings.get_setting("record_queue_size", 60),
+                drop_policy=settings.get_setting("record_drop_policy", "oldest"),
+                labels=self.labels)
+            # Bayer frames are captured before they are demosaiced, as the
+            # camera delivered them
+            self.source.keep_raw = self.source.pixel_format != "BGR8"
+
+    def detach_outputs(self, outputs=OUTPUT_SETTINGS.keys()):
+        # the recorders are returned to be closed, that waits for their
+        # queued frames
+        recorders = []
+        if "recording" in outputs and isinstance(self.sink, RecordingSink):
+            recorders.append(self.sink.recorder)
+            self.sink = self.sink.sink
+        if "capture" in outputs and not self.capture is None:
+            recorders.append(self.capture)
+            self.capture = None
+            self.source.keep_raw = False
+        if "publisher" in outputs and not self.publisher is None:
+            self.publisher.close()
+            self.publisher = None
+        return recorders
+
+    def close_outputs(self):
+        for recorder in self.detach_outputs():
+            recorder.close()
+
+    def reopen_outputs(self, outputs):
+        recorders = self.detach_outputs(outputs)
+        closer = threading.Thread(
+            target=lambda: [recorder.close() for recorder in recorders])
+        closer.start()
+        self.output_closers = [thread for thread in self.output_closers
+                               if thread.is_alive()] + [closer]
+        paths = [settings.get_setting("record_path", None),
+                 settings.get_setting("capture_path", None)]
+        if any(recorder.path in paths for recorder in recorders):
+            # the same file is written again, the old one has to be done
+            closer.join()
+        self.open_outputs(outputs)
+
+    def apply_settings(self):
+        with self.settings_lock:
+            changed = self.changed_settings
+            self.changed_settings = set()
+        if len(changed & RESTART_SETTINGS) > 0:
+            self.source.stop()
+            self.pipeline.close()
+            self.close_outputs()
+            self.sink.close()
+            self.slot.release()
+            self.clear_face()
+            self.configure()
+            self.source.start()
+        else:
+            outputs = [output for output, names in OUTPUT_SETTINGS.items()
+                       if len(changed & names) > 0]
+            if len(outputs) > 0:
+                self.reopen_outputs(outputs)
+            if "face_tracking" in changed:
+                self.tracking_enabled = settings.get_setting(
+                    "face_tracking", True)
+                if not self.tracking_enabled:
+                    self.tracker.stop()
+            if "max_exposure_time" in changed:
+                self.source.update_settings()
+            if "feature_write_interval" in changed:
+                self.commands.min_interval = settings.get_setting(
+                    "feature_write_interval", 0.05)
+            if len(changed & COLOR_SETTINGS.keys()) > 0:
+                self.pipeline.update_settings()
+
+    def enable_preview(self):
+        self.preview_enabled = True
+
+    def disable_preview(self):
+        self.preview_enabled = False
+
+    def send_face(self, face):
+        self.detection = (self.detection[0] + 1, face)
+
+    def clear_face(self):
+        # a face that arrives before this is from the old frames, it must
+        # not start the tracker on the new ones
+        self.face = None
+        self.last_face_id = self.detection[0]
+        self.tracker.stop()
+
+    def collect_metrics(self):
+        values = {}
+        frame_pool = self.frame_pool
+        if not frame_pool is None:
+            values["frame_pool_exhausted_total"] = frame_pool.num_exhausted
+            values["frame_pool_free_slots"] = frame_pool.num_free()
+        nodes = self.nodes
+        if not nodes is None:
+            for name, value in nodes.counters().items():
+                values["camera_node_{}_total".format(name)] = value
+        source = self.source
+        if hasattr(source, "counters"):
+            values.update(source.counters())
+        return values
+
+    def run(self):
+        self.source.start()
+        i = 0
+        num_frames_no_face = 0
+        full_frame_auto = False
+        sent_seq = 0
+        start_time = time.perf_counter()
+        while self.running:
+            # settings wait until the camera is back
+            if len(self.changed_settings) > 0 and self.reconnect_time is None:
+                self.apply_settings()
+
+            # if every slot is still in use or the camera is lost we resend
+            # the last frame, the sink keeps its consumers
+            new_frame = False
+            slot = None
+            if self.reconnect_time is None:
+                slot = self.frame_pool.acquire()
+            else:
+                self.reconnect()
+            if not slot is None:
+                frame = None
+                try:
+                    frame = self.source.grab_into(slot.buffer)
+                except genicam.GenericException:
+                    self.camera_lost()
+                if frame is None:
+                    slot.release()
+                    self.duplicated_frames.inc()
+                else:
+                    slot.array = frame
+                    slot.timestamp = self.source.frame_time
+                    self.slot.release()
+                    self.slot = slot
+                    new_frame = True
+            else:
+                self.duplicated_frames.inc()
+            t = self.observe("retrieve", start_time)
+
+            crop = None
+            if not self.framing is None:
+                self.framing.update(self.face)
+                crop = self.framing.crop_rect()
+            self.pipeline.submit(self.slot, crop)
+            job = self.pipeline.next_output()
+            t = self.observe("process", t)
+            # nothing to send until the pipeline filled up
+            if not job is None:
+                self.sink.send(job.frame)
+                if not self.publisher is None:
+                    self.publisher.publish(job.frame, job.slot.timestamp)
+                t = self.observe("send", t)
+                # duplicates of the last frame don't count, they are older
+                if job.slot.seq != sent_seq:
+                    self.frame_age.observe(t - job.slot.timestamp)
+                    sent_seq = job.slot.seq
+                job.slot.release()
+
+            self.slot.retain(self.frame_consumers)
+            self.frame_grabbed.emit(self.slot)
+
+            if i % 10 == 0:
+                self.avg_fps.emit(self.sink.avg_fps)
+            t = self.observe("emit", t)
+
+            face_id, face = self.detection
+            new_face = face_id != self.last_face_id and not face is None
+            if new_face:
+                self.last_face_id = face_id
+                self.face = face
+                num_frames_no_face = 0
+                if self.tracking_enabled:
+                    self.tracker.start(self.slot.array, face)
+            elif self.tracker.is_tracking():
+                # follow the face every frame, only ask the detector again
+                # once the track is lost
+                self.face = self.tracker.update(self.slot.array)
+                if self.face is None:
+                    self.track_lost.emit()
+                else:
+                    self.face_tracked.emit(self.face)
+            elif not self.face is None:
+                if num_frames_no_face > self.fps * 11:
+                    self.face = None
+                num_frames_no_face += 1
+            if new_frame and not self.capture is None:
+                frame = self.slot.array
+                if self.capture.pixel_format != "BGR8":
+                    frame = self.source.raw
+                self.capture.send(frame, self.slot.timestamp, self.face)
+            t = self.observe("track", t)
+
+            if self.reconnect_time is None:
+                try:
+                    if not self.nodes is None:
+                        if not self.face is None:
+                            if self.framing is None:
+                                center_face(self.nodes, self.face)
+                            if new_face:
+                                set_auto_functions(self.nodes, self.face)
+                            full_frame_auto = False
+                        elif not full_frame_auto:
+                            # only once after the face is gone, every call
+                            # starts a new auto adjustment
+                            set_auto_functions(self.nodes, np.array(
+                                [0, 0, self.nodes.get("Width"), self.nodes.get("Height")]))
+                            full_frame_auto = True
+                except genicam.GenericException:
+                    # e.g. a value out of range, only a removed device is
+                    # opened again
+                    if self.source.camera.IsCameraDeviceRemoved():
+                        self.camera_lost()
+                    else:
+                        self.failed_writes.inc()
+                if not self.source.camera is None and self.reconnect_time is None:
+                    self.commands.apply(self.source.camera)
+            t = self.observe("camera", t)
+            # a source with its own clock already waited for the frame,
+            # unless it is lost
+            if not self.source.paced or not self.reconnect_time is None:
+                self.sink.sleep_until_next_frame()
+            end_time = self.observe("sleep", t)
+            self.frame_time.observe(end_time - start_time)
+            start_time = end_time
+            i += 1
+
+        self.pipeline.close()
+        if not self.reconnector is None:
+            self.reconnector.join()
+            self.reconnector = None
+        self.close_outputs()
+        for closer in self.output_closers:
+            closer.join()
+        self.output_closers = []
+        self.sink.close()
+        self.source.close()
+        self.slot.release()
+        self.sink = None
+        self.capture = None
+        self.publisher = None
+        self.source = None
+        self.slot = None
+        self.frame_pool = None
+        self.pipeline = None
+        self.framing = None
+        self.nodes = None
+        self.camera = None
+        self.running = True
+        self.reconnect_time = None
+        self.clear_face()
+        self.preview_enabled = False
+        self.finished.emit()
+        self.avg_fps.emit(0)
+
+    def camera_lost(self):
+        if not hasattr(self.source, "reconnect"):
+            self.running = False
+            return
+        self.lost_cameras.inc()
+        # the first attempt right away, a short USB hiccup is over by then
+        self.reconnect_delay = settings.get_setting("reconnect_delay", 0.1)
+        self.reconnect_time = time.perf_counter()
+        self.tracker.stop()
+
+    def reconnect(self):
+        # the attempt runs in its own thread, the grab loop keeps sending
+        # the last frame meanwhile
+        if not self.reconnector is None:
+            if self.reconnector.is_alive():
+                return
+            self.reconnector = None
+            if self.reconnect_succeeded:
+                self.camera_back()
+            else:
+                self.reconnect_time = time.perf_counter() + self.reconnect_delay
+                self.reconnect_delay = min(
+                    self.reconnect_delay * 2,
+                    settings.get_setting("reconnect_max_delay", 5))
+        elif time.perf_counter() >= self.reconnect_time:
+            self.reconnect_attempts.inc()
+            self.reconnect_succeeded = False
+            self.reconnector = threading.Thread(target=self.open_camera_again)
+            self.reconnector.start()
+
+    def open_camera_again(self):
+        try:
+            self.source.reconnect()
+            self.reconnect_succeeded = True
+        except genicam.GenericException:
+            # e.g. the device didn't show up again yet
+            pass
+
+    def camera_back(self):
+        if not self.nodes is None:
+            try:
+                self.nodes.invalidate()
+                self.nodes.snapshot(STEERING_NODES)
+            except genicam.GenericException:
+                # gone again right away
+                self.camera_lost()
+                return
+        self.reconnect_time = None
+        # what was changed since the last configure
+        self.commands.restore()
+        self.reconnected.emit()
+
+    def observe(self, stage, start_time):
+        now = time.perf_counter()
+        self.stage_times[stage].observe(now - start_time)
+        return now
+
+
+def set_auto_functions(nodes, face):
+    offX = nodes.get("OffsetX")
+    offY = nodes.get("OffsetY")
+
+    startX = face[0]
+    startY = face[1]
+    endX = face[2]
+    endY = face[3]
+
+    face_width = endX - startX
+    face_height = endY - startY
+    face_abs_start_x = offX + startX
+    face_abs_start_y = offY + startY
+
+    nodes.set_int("AutoFunctionROIWidth", face_width)
+    nodes.set_int("AutoFunctionROIHeight", face_height)
+    nodes.set_int("AutoFunctionROIOffsetX", face_abs_start_x)
+    nodes.set_int("AutoFunctionROIOffsetY", face_abs_start_y)
+
+    # the camera falls back to "Off" once it is done, so this is always
+    # written to start a new adjustment
+    nodes.write("BalanceWhiteAuto", "Once")
+    nodes.write("ExposureAuto", "Once")
+    nodes.write("GainAuto", "Once")
+
+
+def center_face(nodes, face):
+    dead_zone = 100
+    incX = nodes.get_limits("OffsetX")[2]
+    incY = nodes.get_limits("OffsetY")[2]
+    offX = nodes.get("OffsetX")
+    offY = nodes.get("OffsetY")
+
+    startX = face[0]
+    startY = face[1]
+    endX = face[2]
+    endY = face[3]
+
+    face_width = endX - startX
+    face_height = endY - startY
+
+    face_center_x = startX + face_width // 2
+    face_center_y = startY + face_height // 2
+
+    height = nodes.get("Height")
+    width = nodes.get("Width")
+
+    if face_center_x > ((width/2)+dead_zone):
+        new_off_x = offX + incX
+    elif face_center_x < ((width/2)-dead_zone):
+        new_off_x = offX - incX
+    else:
+        new_off_x = offX
+
+    if face_center_y < ((height/2) - dead_zone):
+        new_off_y = offY - incY
+    elif face_center_y > ((height/2) + dead_zone):
+        new_off_y = offY + incY
+    else:
+        new_off_y = offY
+
+    nodes.set_int("OffsetX", new_off_x)
+    nodes.set_int("OffsetY", new_off_y)
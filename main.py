@@ -3,23 +3,55 @@ from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
-from grab_thread import GrabThread
-from preview_thread import PreviewThread
-from face_detector_thread import FaceDetectorThread
 from config_gui import ConfigGui
+from settings_watcher import SettingsWatcher
+from metrics import MetricsServer
+import settings
 
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
 
     app.setWindowIcon(QIcon('pylon_webcam_icon_64.png'))
+    settings_watcher = SettingsWatcher()
+    metrics_port = settings.get_setting("metrics_port", None)
+    if not metrics_port is None:
+        # latency histograms and frame counters on localhost:<port>/metrics
+        metrics_server = MetricsServer(metrics_port)
+        metrics_server.start()
+    if len(settings.get_setting("cameras", [])) > 0:
+        from face_detector_thread import FaceDetectorThread
+        from multi_camera import MultiCameraGui
+        # every camera gets its own grab thread and virtual camera, they
+        # share one face detector
+        gui = MultiCameraGui(FaceDetectorThread())
+        sys.exit(app.exec_())
+
+    # window and tray icon come up first, numpy, OpenCV and pylon are only
+    # imported once they are shown
+    gui = ConfigGui()
+    app.processEvents()
+    from grab_thread import GrabThread
+    from preview_thread import PreviewThread
+    from face_detector_thread import FaceDetectorThread
+
     grab_thread = GrabThread()
     preview_thread = PreviewThread()
     face_detector_thread = FaceDetectorThread()
-    grab_thread.frame_grabbed.connect(preview_thread.send_frame)
-    grab_thread.frame_grabbed.connect(face_detector_thread.send_frame)
+    # the frames go straight to the other threads, a busy GUI thread would
+    # hold on to the slots and empty the pool of the grab loop
+    grab_thread.add_frame_consumer(preview_thread.send_frame,
+                                   Qt.DirectConnection)
+    grab_thread.add_frame_consumer(face_detector_thread.send_frame,
+                                   Qt.DirectConnection)
     face_detector_thread.found_face.connect(grab_thread.send_face)
     face_detector_thread.found_face.connect(preview_thread.send_face)
-    gui = ConfigGui(grab_thread, preview_thread, face_detector_thread)
+    grab_thread.face_tracked.connect(preview_thread.send_face)
+    grab_thread.track_lost.connect(preview_thread.clear_face)
+    grab_thread.track_lost.connect(face_detector_thread.request_detection)
+    grab_thread.avg_fps.connect(preview_thread.send_fps)
+    face_detector_thread.detection_latency.connect(
+        preview_thread.send_detector_latency)
+    gui.attach_threads(grab_thread, preview_thread, face_detector_thread)
 
     sys.exit(app.exec_())
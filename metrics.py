@@ -0,0 +1,199 @@
+import bisect
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# upper bounds in seconds, from 50us up to 1s
+LATENCY_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+histograms = {}
+counters = {}
+collectors = []
+lock = threading.Lock()
+
+
+class Histogram:
+
+    def __init__(self, name, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        # every histogram is written by a single thread, so no lock here
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def take(self):
+        # what was observed since the last call, e.g. to send it from a
+        # worker process to the one serving the metrics
+        taken = (self.counts, self.sum, self.count)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        return taken
+
+    def merge(self, counts, sum, count):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += sum
+        self.count += count
+
+    def snapshot(self):
+        return {
+            "labels": dict(self.labels),
+            "buckets": dict(zip(self.buckets, self.counts)),
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+
+class Counter:
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+def histogram(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        if not key in histograms:
+            histograms[key] = Histogram(name, key[1])
+        return histograms[key]
+
+
+def counter(name, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        if not key in counters:
+            counters[key] = Counter(name, key[1])
+        return counters[key]
+
+
+def add_collector(collector, **labels):
+    # collectors return {name: value} and are called for every scrape,
+    # e.g. for counters that live in other objects
+    with lock:
+        collectors.append((collector, tuple(sorted(labels.items()))))
+
+
+def remove_collector(collector):
+    with lock:
+        collectors[:] = [(c, labels) for (c, labels) in collectors
+                         if c != collector]
+
+
+def collect_gauges():
+    # (name, labels, value), the same name comes from every camera
+    gauges = []
+    with lock:
+        current = list(collectors)
+    for collector, labels in current:
+        gauges.extend((name, labels, value)
+                      for name, value in collector().items())
+    return sorted(gauges, key=lambda gauge: gauge[:2])
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, value)
+                          for name, value in labels) + "}"
+
+
+def render_prometheus():
+    with lock:
+        current_histograms = sorted(histograms.values(),
+                                    key=lambda h: (h.name, h.labels))
+        current_counters = sorted(counters.values(),
+                                  key=lambda c: (c.name, c.labels))
+    lines = []
+    last_name = None
+    for h in current_histograms:
+        if h.name != last_name:
+            lines.append("# TYPE {} histogram".format(h.name))
+            last_name = h.name
+        cumulative = 0
+        for bound, count in zip(h.buckets + ["+Inf"], list(h.counts)):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                h.name, format_labels(h.labels, [("le", bound)]), cumulative))
+        lines.append("{}_sum{} {}".format(h.name, format_labels(h.labels), h.sum))
+        lines.append("{}_count{} {}".format(h.name, format_labels(h.labels), h.count))
+    for c in current_counters:
+        if c.name != last_name:
+            lines.append("# TYPE {} counter".format(c.name))
+            last_name = c.name
+        lines.append("{}{} {}".format(c.name, format_labels(c.labels), c.value))
+    for name, labels, value in collect_gauges():
+        if name != last_name:
+            lines.append("# TYPE {} gauge".format(name))
+            last_name = name
+        lines.append("{}{} {}".format(name, format_labels(labels), value))
+    return "\n".join(lines) + "\n"
+
+
+def snapshot():
+    with lock:
+        current_histograms = list(histograms.values())
+        current_counters = list(counters.values())
+    result = {"histograms": {}, "counters": {}, "gauges": {}}
+    for h in current_histograms:
+        result["histograms"].setdefault(h.name, []).append(h.snapshot())
+    for c in current_counters:
+        result["counters"].setdefault(c.name, []).append(
+            {"labels": dict(c.labels), "value": c.value})
+    for name, labels, value in collect_gauges():
+        result["gauges"].setdefault(name, []).append(
+            {"labels": dict(labels), "value": value})
+    return result
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = render_prometheus().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body = json.dumps(snapshot(), indent=4).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer:
+
+    def __init__(self, port):
+        # only reachable from this machine
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
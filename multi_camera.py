@@ -0,0 +1,110 @@
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from grab_thread import GrabThread
+from frame_source import PylonSource, create_source, open_camera
+import settings
+
+
+class CameraPipeline:
+
+    def __init__(self, camera_settings, face_detector_thread):
+        self.camera_settings = camera_settings
+        self.name = camera_settings.get(
+            "name", camera_settings.get("serial", "Camera"))
+        self.grab_thread = GrabThread(self.name)
+        self.detector_client = face_detector_thread.add_client()
+        # not through the event loop of the GUI thread, see main.py
+        self.grab_thread.add_frame_consumer(self.detector_client.send_frame,
+                                            Qt.DirectConnection)
+        self.detector_client.found_face.connect(self.grab_thread.send_face)
+        self.grab_thread.track_lost.connect(
+            self.detector_client.request_detection)
+
+        self.thread = QThread()
+        self.grab_thread.moveToThread(self.thread)
+        self.thread.started.connect(self.grab_thread.run)
+
+    def is_open(self):
+        return not self.grab_thread.source is None
+
+    def open(self):
+        if self.thread.isRunning():
+            # the last session ended on its own, e.g. after a camera error
+            self.thread.exit()
+            self.thread.wait()
+        source_name = self.camera_settings.get("source", "pylon")
+        if source_name == "pylon":
+            source = PylonSource(open_camera(self.camera_settings["serial"]))
+        else:
+            source = create_source(source_name)
+        self.grab_thread.set_source(
+            source, sink_device=self.camera_settings.get("device"))
+        self.thread.start()
+
+    def close(self):
+        self.grab_thread.stop()
+        self.thread.exit()
+        self.thread.wait()
+
+
+class MultiCameraGui(QWidget):
+
+    def __init__(self, face_detector_thread):
+        super().__init__()
+        self.face_detector_thread = face_detector_thread
+        self.face_thread = QThread()
+        self.face_detector_thread.moveToThread(self.face_thread)
+        self.face_thread.started.connect(self.face_detector_thread.run)
+        self.face_thread.start()
+
+        vbox = QVBoxLayout()
+        self.pipelines = []
+        for camera_settings in settings.get_setting("cameras", []):
+            pipeline = CameraPipeline(
+                camera_settings, self.face_detector_thread)
+            self.pipelines.append(pipeline)
+            vbox.addLayout(self.create_camera_row(pipeline))
+
+        vbox.addStretch()
+        self.setLayout(vbox)
+        self.setGeometry(50, 50, 320, 100)
+        self.setWindowTitle("Pylon Webcam")
+        self.show()
+
+    def create_camera_row(self, pipeline):
+        label = QLabel(pipeline.name)
+        fps_label = QLabel("FPS:  0.00")
+        button = QPushButton("Open")
+        pipeline.grab_thread.avg_fps.connect(
+            lambda value: fps_label.setText("FPS: {:2.2f}".format(value)))
+        pipeline.grab_thread.finished.connect(
+            lambda: button.setText("Open"))
+        button.clicked.connect(
+            lambda: self.toggle_camera(pipeline, button))
+
+        row = QHBoxLayout()
+        row.addWidget(label)
+        row.addStretch()
+        row.addWidget(fps_label)
+        row.addWidget(button)
+        return row
+
+    def toggle_camera(self, pipeline, button):
+        if pipeline.is_open():
+            pipeline.close()
+            button.setText("Open")
+            return
+        try:
+            pipeline.open()
+        except Exception:
+            QMessageBox.critical(
+                self, "Error", f"Camera\n{pipeline.name}\ncould not be opened")
+            return
+        button.setText("Close")
+
+    def closeEvent(self, event):
+        for pipeline in self.pipelines:
+            if pipeline.is_open():
+                pipeline.close()
+        super().closeEvent(event)
@@ -1,10 +1,14 @@
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
+import numpy as np
 import cv2
 import time
+import threading
 from face_finder import draw_face_box
+from stages import COLOR_SETTINGS, DEFAULT_STAGES, LutStage, StageJob
 import settings
+import metrics
 
 
 class PreviewThread(QObject):
@@ -18,37 +22,136 @@ class PreviewThread(QObject):
         self.running = True
         self.preview_enabled = False
         self.face = None
+        self.slot = None
+        self.slot_lock = threading.Lock()
+        self.resize_window = False
+        self.preview_frame = None
+        self.color = None
+        self.color_job = StageJob(None, 0, None)
+        self.fps = settings.get_setting("preview_fps", 15)
+        self.output_fps = 0
+        self.detector_latency = 0
+        self.compose_times = metrics.histogram("preview_compose_seconds")
+        # frames replaced by a newer one before the preview showed them
+        self.dropped_frames = metrics.counter("preview_frames_dropped_total")
+        self.last_seq = None
+        settings.add_listener(self.settings_changed)
 
     def stop(self):
         self.running = False
 
-    def enable_preview(self):
-        cv2.namedWindow(self.window_name, cv2.WINDOW_NORMAL)
-        self.preview_enabled = True
+    def settings_changed(self, changed):
+        if "preview_resolution" in changed or "stages" in changed:
+            # the window belongs to the preview thread
+            self.resize_window = True
+        color = self.color
+        if not color is None and len(changed & COLOR_SETTINGS.keys()) > 0:
+            color.update_settings()
+        if "preview_fps" in changed:
+            self.fps = settings.get_setting("preview_fps", 15)
+
+    def update_window_size(self):
+        self.resize_window = False
         resolution = settings.get_setting(
             "preview_resolution", self.vga_resolution)
+        self.preview_frame = np.empty(
+            (resolution[1], resolution[0], 3), np.uint8)
+        # the frames come from before the stages, the color correction of
+        # the virtual camera is done again on the small preview frame
+        self.color = None
+        stages = [entry if isinstance(entry, str) else entry["stage"]
+                  for entry in settings.get_setting("stages", DEFAULT_STAGES)]
+        if "lut" in stages:
+            self.color = LutStage(self.preview_frame.shape, 1)
         cv2.resizeWindow(self.window_name, resolution[0], resolution[1])
 
+    def enable_preview(self):
+        cv2.namedWindow(self.window_name, cv2.WINDOW_NORMAL)
+        self.preview_enabled = True
+        self.update_window_size()
+
     def disable_preview(self):
         self.preview_enabled = False
 
-    def send_frame(self, frame):
-        self.frame = frame
+    def send_frame(self, slot):
+        with self.slot_lock:
+            if not self.slot is None:
+                if self.preview_enabled and self.slot.seq != self.last_seq:
+                    self.dropped_frames.inc()
+                self.slot.release()
+            self.slot = slot
+
+    def take_slot(self):
+        with self.slot_lock:
+            slot = self.slot
+            if not slot is None:
+                slot.retain()
+        return slot
 
     def send_face(self, face):
         self.face = face
 
+    def clear_face(self):
+        self.face = None
+
+    def send_fps(self, fps):
+        self.output_fps = fps
+
+    def send_detector_latency(self, latency):
+        self.detector_latency = latency
+
+    def compose(self, frame):
+        # everything is drawn on our own small copy, the shared frame
+        # goes to the virtual camera untouched
+        (h, w) = frame.shape[:2]
+        (preview_h, preview_w) = self.preview_frame.shape[:2]
+        preview = cv2.resize(frame, (preview_w, preview_h),
+                             dst=self.preview_frame,
+                             interpolation=cv2.INTER_LINEAR)
+        if not self.color is None:
+            preview = self.color.process(preview, self.color_job)
+        face = self.face
+        if not face is None:
+            scale = np.array([preview_w / w, preview_h / h,
+                              preview_w / w, preview_h / h])
+            draw_face_box(preview, (np.array(face[0:4]) * scale).astype(int))
+        text = "FPS: {:2.1f}  Detector: {:3.0f} ms".format(
+            self.output_fps, self.detector_latency * 1000)
+        cv2.putText(preview, text, (10, 20), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.5, (0, 255, 0), 1, cv2.LINE_AA)
+        return preview
+
     def run(self):
+        next_time = time.perf_counter()
         while self.running:
             if self.preview_enabled:
                 if cv2.getWindowProperty(self.window_name, cv2.WND_PROP_VISIBLE) < 1:
                     self.preview_toggle.emit()
                     self.preview_enabled = False
                 else:
-                    if not self.face is None:
-                        draw_face_box(self.frame, self.face)
-                    cv2.imshow(self.window_name, self.frame)
-                    cv2.waitKey(30)
+                    if self.resize_window or self.preview_frame is None:
+                        self.update_window_size()
+                    slot = self.take_slot()
+                    if not slot is None:
+                        if slot.seq != self.last_seq:
+                            self.last_seq = slot.seq
+                            start_time = time.perf_counter()
+                            preview = self.compose(slot.array)
+                            slot.release()
+                            self.compose_times.observe(
+                                time.perf_counter() - start_time)
+                            cv2.imshow(self.window_name, preview)
+                        else:
+                            slot.release()
+                    cv2.waitKey(1)
+                # the preview runs at its own rate, independent of the camera
+                next_time += 1 / self.fps
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    next_time = time.perf_counter()
             else:
                 cv2.destroyWindow(self.window_name)
                 time.sleep(0.03)
+                next_time = time.perf_counter()
@@ -0,0 +1,152 @@
+import json
+import os
+import time
+import numpy as np
+import settings
+from recorder import Recorder
+from demosaic import Demosaicer, parse_pixel_format
+
+MAGIC = b"PYWCRAW1"
+# frames start on a page boundary, so the file can be mapped as it is
+HEADER_SIZE = 4096
+
+
+def record_dtype(width, height, pixel_format):
+    if pixel_format.startswith("Bayer"):
+        bits = parse_pixel_format(pixel_format)[1]
+        pixels = (np.uint16 if bits > 8 else np.uint8, (height, width))
+    else:
+        pixels = (np.uint8, (height, width, 3))
+    # the face is the one the pipeline used for this frame
+    return np.dtype([("timestamp", "<f8"), ("face", "<i4", (4,)),
+                     ("has_face", "<u4"), ("pixels",) + pixels])
+
+
+class CaptureWriter(Recorder):
+
+    metrics_name = "capture"
+
+    def __init__(self, path, width, height, fps, pixel_format="BGR8",
+                 queue_size=60, drop_policy="oldest", labels=None):
+        self.pixel_format = pixel_format
+        self.record_dtype = record_dtype(width, height, pixel_format)
+        super().__init__(path, width, height, fps, "BGR", "raw",
+                         queue_size, drop_policy, labels)
+
+    def make_buffer(self, width, height, output_format):
+        return np.zeros(1, self.record_dtype)
+
+    def open(self, path, width, height, fps, output_format, codec):
+        header = json.dumps({"width": width, "height": height,
+                             "pixel_format": self.pixel_format, "fps": fps})
+        self.file = open(path, "wb")
+        self.file.write((MAGIC + header.encode()).ljust(HEADER_SIZE, b"\0"))
+
+    def fill(self, buffer, frame, timestamp, face):
+        buffer["timestamp"][0] = timestamp
+        buffer["has_face"][0] = not face is None
+        if not face is None:
+            buffer["face"][0] = face[0:4]
+        np.copyto(buffer["pixels"][0], frame)
+
+
+class CaptureReader:
+
+    def __init__(self, path):
+        with open(path, "rb") as capture_file:
+            header = capture_file.read(HEADER_SIZE)
+        if not header.startswith(MAGIC):
+            raise ValueError(f"'{path}' is not a raw capture")
+        info = json.loads(header[len(MAGIC):].rstrip(b"\0"))
+        self.width = info["width"]
+        self.height = info["height"]
+        self.pixel_format = info["pixel_format"]
+        self.fps = info["fps"]
+        dtype = record_dtype(self.width, self.height, self.pixel_format)
+        # a capture that was cut off still has all of its complete frames
+        num_frames = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+        if num_frames == 0:
+            raise ValueError(f"'{path}' contains no frames")
+        self.records = np.memmap(path, dtype, "r", HEADER_SIZE, (num_frames,))
+        self.timestamps = self.records["timestamp"]
+
+    def __len__(self):
+        return len(self.records)
+
+    def frame(self, index):
+        return self.records["pixels"][index]
+
+    def face(self, index):
+        if not self.records["has_face"][index]:
+            return None
+        return np.array(self.records["face"][index])
+
+
+class ReplaySource:
+
+    camera = None
+
+    def __init__(self, path, speed="original", loop=True):
+        self.reader = CaptureReader(path)
+        self.width = self.reader.width
+        self.height = self.reader.height
+        # "original" keeps the recorded frame intervals, "max" delivers
+        # frames as fast as the pipeline takes them
+        self.speed = speed
+        self.loop = loop
+        # at the recorded intervals the recording is the clock of the pipeline
+        self.paced = speed == "original"
+        self.pixel_format = self.reader.pixel_format
+        # the mapped frame, a Bayer capture is captured again as it is
+        self.keep_raw = False
+        self.raw = None
+        self.demosaicer = None
+        self.index = 0
+        self.frame_time = 0
+
+    def configure(self, input_res, output_res, fps):
+        # the recording decides the frame size, the pipeline resizes
+        if not self.demosaicer is None:
+            self.demosaicer.close()
+            self.demosaicer = None
+        if self.reader.pixel_format.startswith("Bayer"):
+            self.demosaicer = Demosaicer(
+                self.width, self.height, self.reader.pixel_format,
+                settings.get_setting("demosaic_threads", None))
+
+    def start(self):
+        self.index = 0
+        self.time_offset = None
+
+    def stop(self):
+        pass
+
+    def update_settings(self):
+        pass
+
+    def grab_into(self, out):
+        if self.index >= len(self.reader):
+            if not self.loop:
+                return None
+            self.index = 0
+            self.time_offset = None
+        if self.speed == "original":
+            timestamp = self.reader.timestamps[self.index]
+            if self.time_offset is None:
+                self.time_offset = time.perf_counter() - timestamp
+            delay = timestamp + self.time_offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        frame = self.reader.frame(self.index)
+        self.raw = frame
+        self.frame_time = time.perf_counter()
+        self.index += 1
+        if self.demosaicer is None:
+            # no copy, the pipeline reads straight from the mapped file
+            return frame
+        return self.demosaicer.convert(frame, out)
+
+    def close(self):
+        if not self.demosaicer is None:
+            self.demosaicer.close()
+            self.demosaicer = None
@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import deque
+import numpy as np
+import cv2
+import metrics
+
+
+class Recorder:
+
+    metrics_name = "recording"
+
+    def __init__(self, path, width, height, fps, output_format="BGR",
+                 codec="MJPG", queue_size=60, drop_policy="oldest",
+                 labels=None):
+        self.path = path
+        self.labels = labels or {}
+        self.drop_policy = drop_policy
+        # frames are copied into these buffers, the queue never grows
+        # beyond them
+        self.free = [self.make_buffer(width, height, output_format)
+                     for _ in range(queue_size)]
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.writer = None
+        self.file = None
+        self.open(path, width, height, fps, output_format, codec)
+        self.dropped_frames = metrics.counter(
+            f"{self.metrics_name}_frames_dropped_total", **self.labels)
+        self.write_times = metrics.histogram(
+            f"{self.metrics_name}_write_seconds", **self.labels)
+        metrics.add_collector(self.collect_metrics, **self.labels)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def make_buffer(self, width, height, output_format):
+        if output_format == "BGR":
+            return np.empty((height, width, 3), np.uint8)
+        return np.empty((height * 3 // 2, width), np.uint8)
+
+    def open(self, path, width, height, fps, output_format, codec):
+        # VideoWriter only takes BGR, YUV output is written as it is
+        if codec == "raw" or output_format != "BGR":
+            self.file = open(path, "wb")
+        else:
+            self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*codec),
+                                          fps, (width, height))
+            if not self.writer.isOpened():
+                raise ValueError(f"Can't record to '{path}' with codec '{codec}'")
+
+    def fill(self, buffer, frame):
+        np.copyto(buffer, frame)
+
+    def write(self, buffer):
+        if self.writer is None:
+            self.file.write(buffer.data)
+        else:
+            self.writer.write(buffer)
+
+    @property
+    def backlog(self):
+        return len(self.queue)
+
+    def collect_metrics(self):
+        return {f"{self.metrics_name}_backlog_frames": self.backlog}
+
+    def send(self, frame, *args):
+        # called from the grab loop, must never wait for the disk
+        with self.condition:
+            if len(self.free) > 0:
+                buffer = self.free.pop()
+            elif self.drop_policy == "oldest" and len(self.queue) > 0:
+                buffer = self.queue.popleft()
+                self.dropped_frames.inc()
+            else:
+                self.dropped_frames.inc()
+                return
+        self.fill(buffer, frame, *args)
+        with self.condition:
+            self.queue.append(buffer)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and len(self.queue) == 0:
+                    self.condition.wait()
+                if len(self.queue) == 0:
+                    break
+                buffer = self.queue.popleft()
+            start_time = time.perf_counter()
+            self.write(buffer)
+            self.write_times.observe(time.perf_counter() - start_time)
+            with self.condition:
+                self.free.append(buffer)
+
+    def close(self):
+        # frames that are already queued are still written
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        if self.writer is None:
+            self.file.close()
+        else:
+            self.writer.release()
+        metrics.remove_collector(self.collect_metrics)
+
+
+class RecordingSink:
+
+    def __init__(self, sink, recorder):
+        self.sink = sink
+        self.recorder = recorder
+
+    @property
+    def avg_fps(self):
+        return self.sink.avg_fps
+
+    @property
+    def paced(self):
+        return self.sink.paced
+
+    @paced.setter
+    def paced(self, paced):
+        self.sink.paced = paced
+
+    def __getattr__(self, name):
+        # e.g. stats() of the counting sink
+        return getattr(self.sink, name)
+
+    def send(self, frame):
+        self.sink.send(frame)
+        self.recorder.send(frame)
+
+    def sleep_until_next_frame(self):
+        self.sink.sleep_until_next_frame()
+
+    def close(self):
+        self.sink.close()
+        self.recorder.close()
@@ -0,0 +1,28 @@
+from camera_nodes import is_writable
+
+
+def plan_resolution(camera, input_res, output_res, max_factor=4):
+    plan = {"binning": 1, "decimation": 1,
+            "width": input_res[0], "height": input_res[1]}
+    if list(input_res) == list(output_res):
+        return plan
+
+    # binning keeps all the light, so it is preferred over decimation
+    for feature in ["Binning", "Decimation"]:
+        horizontal = feature + "Horizontal"
+        vertical = feature + "Vertical"
+        if not is_writable(camera, horizontal) or not is_writable(camera, vertical):
+            continue
+        factor_max = min(getattr(camera, horizontal).Max,
+                         getattr(camera, vertical).Max, max_factor)
+        # the largest factor that still delivers at least the output size,
+        # the rest is done on the host
+        for factor in range(factor_max, 1, -1):
+            width = input_res[0] // factor
+            height = input_res[1] // factor
+            if width >= output_res[0] and height >= output_res[1]:
+                plan[feature.lower()] = factor
+                plan["width"] = width
+                plan["height"] = height
+                return plan
+    return plan
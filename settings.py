@@ -1,34 +1,86 @@
 import json
 import os
+import tempfile
+import threading
 
-mod_time = 0
 data = None
+lock = threading.Lock()
+listeners = []
 SETTINGS_FILE_NAME = "settings.json"
 
 
-def update_settings():
+def load_settings():
     global data
-    global mod_time
-    cur_mod_time = os.path.getmtime(SETTINGS_FILE_NAME)
+    with open(SETTINGS_FILE_NAME) as settings_file:
+        new_data = json.load(settings_file)
+    with lock:
+        old_data = data if not data is None else {}
+        data = new_data
+    return {name for name in set(old_data) | set(new_data)
+            if old_data.get(name) != new_data.get(name)}
 
-    if mod_time != cur_mod_time:
-        settings_file = open(SETTINGS_FILE_NAME)
-        data = json.load(settings_file)
-        mod_time = cur_mod_time
+
+def reload_settings():
+    try:
+        changed = load_settings()
+    except (OSError, ValueError):
+        # e.g. an editor that is still writing the file, keep the old values
+        return
+    if len(changed) > 0:
+        notify_listeners(changed)
 
 
 def get_setting(name, default=None):
-    update_settings()
-    if name in data:
-        return data[name]
-    else:
-        return default
+    # the file is only read once, changes arrive through reload_settings
+    if data is None:
+        load_settings()
+    return data.get(name, default)
+
+
+def set_setting(name, value, persist=True):
+    if data is None:
+        load_settings()
+    with lock:
+        data[name] = value
+    # values that change many times a second, e.g. from a slider, are
+    # saved later with save_settings
+    if persist:
+        save_settings()
+    notify_listeners({name})
+
+
+def save_settings():
+    with lock:
+        content = json.dumps(data, indent=4, sort_keys=True)
+    write_atomic(SETTINGS_FILE_NAME, content)
+
+
+def write_atomic(file_name, content):
+    # readers see either the old or the new file, never a partial one
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_name, file_name)
+    except:
+        os.unlink(tmp_name)
+        raise
+
+
+def add_listener(listener):
+    listeners.append(listener)
+
+
+def remove_listener(listener):
+    listeners.remove(listener)
 
 
-def set_setting(name, value):
-    update_settings()
-    data[name] = value
-    json.dump(data, SETTINGS_FILE_NAME, indent=4, sort_keys=True)
+def notify_listeners(changed):
+    for listener in list(listeners):
+        listener(changed)
 
 
 if __name__ == "__main__":
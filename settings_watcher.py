@@ -0,0 +1,31 @@
+import os
+from PyQt5.QtCore import *
+import settings
+
+
+class SettingsWatcher(QObject):
+
+    def __init__(self):
+        super().__init__()
+        self.path = os.path.abspath(settings.SETTINGS_FILE_NAME)
+        self.watcher = QFileSystemWatcher()
+        # the directory is watched as well, atomic writes replace the file
+        # and the watcher drops replaced files
+        self.watcher.addPath(self.path)
+        self.watcher.addPath(os.path.dirname(self.path))
+        self.watcher.fileChanged.connect(self.on_changed)
+        self.watcher.directoryChanged.connect(self.on_changed)
+
+        # editors write in several steps, wait for them to finish
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(100)
+        self.timer.timeout.connect(self.reload)
+
+    def on_changed(self, path):
+        self.timer.start()
+
+    def reload(self):
+        if not self.path in self.watcher.files() and os.path.exists(self.path):
+            self.watcher.addPath(self.path)
+        settings.reload_settings()
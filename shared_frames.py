@@ -0,0 +1,163 @@
+import time
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+# only numpy and the standard library, so other processes can use the
+# reader without the rest of the application
+
+MAGIC = b"PYWCSHM1"
+ALIGNMENT = 64
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "S8"), ("width", "<u4"), ("height", "<u4"), ("format", "S8"),
+    ("frame_bytes", "<u8"), ("num_slots", "<u4"), ("reserved", "<u4"),
+    # sequence number of the newest complete frame, 0 before the first one
+    ("latest", "<u8"),
+])
+
+# lock is odd while the slot is written, a reader that sees the same even
+# value before and after reading got a consistent frame
+SLOT_DTYPE = np.dtype([("lock", "<u8"), ("seq", "<u8"), ("timestamp", "<f8")])
+
+
+def align(size):
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def frame_shape(width, height, output_format):
+    if output_format == "BGR":
+        return (height, width, 3)
+    # I420 and NV12 have the chroma planes below the Y plane
+    return (height * 3 // 2, width)
+
+
+class SharedFrames:
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.header = np.ndarray((), HEADER_DTYPE, shm.buf)
+        self.width = int(self.header["width"])
+        self.height = int(self.header["height"])
+        self.format = self.header["format"].item().decode()
+        self.num_slots = int(self.header["num_slots"])
+        self.shape = frame_shape(self.width, self.height, self.format)
+        slots_offset = align(HEADER_DTYPE.itemsize)
+        self.slots = np.ndarray((self.num_slots,), SLOT_DTYPE, shm.buf,
+                                slots_offset)
+        frames_offset = slots_offset + align(SLOT_DTYPE.itemsize * self.num_slots)
+        frame_stride = align(int(self.header["frame_bytes"]))
+        self.frames = [np.ndarray(self.shape, np.uint8, shm.buf,
+                                  frames_offset + i * frame_stride)
+                       for i in range(self.num_slots)]
+
+    @staticmethod
+    def size(width, height, output_format, num_slots):
+        frame_bytes = int(np.prod(frame_shape(width, height, output_format)))
+        return (align(HEADER_DTYPE.itemsize) + align(SLOT_DTYPE.itemsize * num_slots)
+                + num_slots * align(frame_bytes))
+
+    def close(self):
+        # the views have to go before the memory can be unmapped
+        self.header = None
+        self.slots = None
+        self.frames = None
+        self.shm.close()
+
+
+class SharedFramePublisher(SharedFrames):
+
+    def __init__(self, name, width, height, output_format="BGR", num_slots=4):
+        size = SharedFrames.size(width, height, output_format, num_slots)
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a publisher that didn't exit cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        header = np.ndarray((), HEADER_DTYPE, shm.buf)
+        header["width"] = width
+        header["height"] = height
+        header["format"] = output_format.encode()
+        header["frame_bytes"] = int(np.prod(frame_shape(width, height, output_format)))
+        header["num_slots"] = num_slots
+        header["latest"] = 0
+        # readers check the magic last, the header is complete by then
+        header["magic"] = MAGIC
+        del header
+        super().__init__(shm)
+        self.seq = 0
+
+    def publish(self, frame, timestamp):
+        # a frame stays untouched for num_slots - 1 frame intervals, enough
+        # for readers to work on it in place
+        self.seq += 1
+        index = self.seq % self.num_slots
+        self.slots["lock"][index] += 1
+        np.copyto(self.frames[index], frame)
+        self.slots["seq"][index] = self.seq
+        self.slots["timestamp"][index] = timestamp
+        self.slots["lock"][index] += 1
+        self.header["latest"] = self.seq
+
+    def close(self):
+        shm = self.shm
+        super().close()
+        shm.unlink()
+
+
+class SharedFrameReader(SharedFrames):
+
+    def __init__(self, name):
+        shm = shared_memory.SharedMemory(name)
+        # the publisher owns the memory, without this Python would remove it
+        # when the reader exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        if bytes(shm.buf[:len(MAGIC)]) != MAGIC:
+            shm.close()
+            raise ValueError(f"'{name}' is not a frame publisher")
+        super().__init__(shm)
+        self.last_seq = 0
+
+    @property
+    def latest(self):
+        return int(self.header["latest"])
+
+    def wait_for_frame(self, timeout=1.0, poll_interval=0.001):
+        # there is no cross process notification, the sequence is polled
+        end_time = time.perf_counter() + timeout
+        while self.latest <= self.last_seq:
+            if time.perf_counter() > end_time:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def view(self):
+        # zero copy access to the newest frame, valid(seq) tells afterwards
+        # whether the publisher overwrote it in the meantime
+        while True:
+            index = self.latest % self.num_slots
+            lock = int(self.slots["lock"][index])
+            if lock % 2 == 1:
+                continue
+            seq = int(self.slots["seq"][index])
+            timestamp = float(self.slots["timestamp"][index])
+            if int(self.slots["lock"][index]) == lock:
+                self.last_seq = seq
+                return self.frames[index], seq, timestamp
+
+    def valid(self, seq):
+        index = seq % self.num_slots
+        return int(self.slots["seq"][index]) == seq and \
+            int(self.slots["lock"][index]) % 2 == 0
+
+    def read(self, out=None):
+        # a consistent copy of the newest frame
+        if out is None:
+            out = np.empty(self.shape, np.uint8)
+        while True:
+            frame, seq, timestamp = self.view()
+            np.copyto(out, frame)
+            if self.valid(seq):
+                return out, seq, timestamp
@@ -0,0 +1,265 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import metrics
+import settings
+from frame_sink import YuvConverter
+from shared_frames import frame_shape
+
+INTERPOLATIONS = {
+    "nearest": cv2.INTER_NEAREST,
+    "linear": cv2.INTER_LINEAR,
+    "area": cv2.INTER_AREA,
+    "cubic": cv2.INTER_CUBIC,
+}
+
+DEFAULT_STAGES = ["framing", "resize", "lut", "convert"]
+
+# default, minimum and maximum, the same ranges as the Bsl nodes of the
+# cameras that can do this themselves
+COLOR_SETTINGS = {
+    "color_gamma": (1.0, 0.0, 4.0),
+    "color_contrast": (0.0, -1.0, 1.0),
+    "color_brightness": (0.0, -1.0, 1.0),
+    "color_saturation": (1.0, 0.0, 2.0),
+    "color_hue": (0.0, -180.0, 180.0),
+}
+
+# luma weights in BGR order, hue and saturation turn around the gray axis
+LUMA = np.array([0.072, 0.715, 0.213])
+
+
+# every stage writes into its own buffer per frame in flight, a frame that
+# is still being worked on is never overwritten by the next one
+
+class CropStage:
+
+    name = "framing"
+
+    def __init__(self, shape, crop_res):
+        self.shape = (crop_res[1], crop_res[0]) + shape[2:]
+
+    def process(self, frame, job):
+        # the rectangle is decided by the grab loop, frames can be worked
+        # on out of order but the framing has to follow them in order
+        startX, startY, endX, endY = job.crop
+        return frame[startY:endY, startX:endX]
+
+
+class ResizeStage:
+
+    name = "resize"
+
+    def __init__(self, shape, output_res, interpolation, depth):
+        self.size = tuple(output_res)
+        self.shape = (output_res[1], output_res[0]) + shape[2:]
+        self.interpolation = INTERPOLATIONS[interpolation]
+        self.buffers = [np.empty(self.shape, np.uint8) for _ in range(depth)]
+
+    def process(self, frame, job):
+        return cv2.resize(frame, self.size, dst=self.buffers[job.index],
+                          interpolation=self.interpolation)
+
+
+class ConvertStage:
+
+    name = "convert"
+
+    def __init__(self, shape, output_format, depth):
+        (height, width) = shape[:2]
+        self.converters = [YuvConverter(width, height, output_format)
+                           for _ in range(depth)]
+        self.shape = self.converters[0].yuv.shape
+
+    def process(self, frame, job):
+        return self.converters[job.index].convert(frame)
+
+
+class DenoiseStage:
+
+    name = "denoise"
+
+    # a light gaussian blur, OpenCV's non local means is far too slow for
+    # every frame
+    def __init__(self, shape, depth, kernel=3):
+        self.shape = shape
+        self.kernel = (kernel, kernel)
+        self.buffers = [np.empty(shape, np.uint8) for _ in range(depth)]
+
+    def process(self, frame, job):
+        return cv2.GaussianBlur(frame, self.kernel, 0, dst=self.buffers[job.index])
+
+
+def tone_table(gamma, contrast, brightness):
+    x = np.linspace(0, 1, 256) ** gamma
+    x = (x - 0.5) * (1 + contrast) + 0.5 + brightness
+    return np.clip(np.round(x * 255), 0, 255).astype(np.uint8)
+
+
+def color_matrix(saturation, hue):
+    gray = np.tile(LUMA, (3, 1))
+    angle = np.radians(hue)
+    # rotation around the gray axis of the BGR cube, as in hue-rotate of
+    # the CSS filter effects
+    rotation = (gray + np.cos(angle) * (np.eye(3) - gray)
+                + np.sin(angle) * np.array([[0.072, 0.715, -0.787],
+                                            [-0.283, 0.140, 0.143],
+                                            [0.928, -0.715, -0.213]]))
+    return gray + saturation * (rotation - gray)
+
+
+class LutStage:
+
+    name = "lut"
+
+    def __init__(self, shape, depth):
+        if len(shape) != 3:
+            raise ValueError("The lut stage has to come before convert")
+        self.shape = shape
+        self.buffers = [np.empty(shape, np.uint8) for _ in range(depth)]
+        self.update_settings()
+
+    def update_settings(self):
+        # the tables are only built when a value changed, per frame there
+        # is one table lookup and, for hue and saturation, one 3x3 transform
+        values = {name: settings.get_setting(name, default)
+                  for name, (default, minimum, maximum) in COLOR_SETTINGS.items()}
+        table = tone_table(values["color_gamma"], values["color_contrast"],
+                           values["color_brightness"])
+        if np.array_equal(table, np.arange(256)):
+            table = None
+        matrix = None
+        if values["color_saturation"] != 1 or values["color_hue"] != 0:
+            matrix = color_matrix(values["color_saturation"], values["color_hue"])
+        # swapped in one go, the workers may be in the middle of a frame
+        self.correction = (table, matrix)
+
+    def process(self, frame, job):
+        table, matrix = self.correction
+        if table is None and matrix is None:
+            return frame
+        out = self.buffers[job.index]
+        if not table is None:
+            frame = cv2.LUT(frame, table, dst=out)
+        if not matrix is None:
+            frame = cv2.transform(frame, matrix, dst=out)
+        return frame
+
+
+# stages that can be added anywhere, each entry of the stages setting is a
+# name or {"stage" : name, <options>}
+STAGES = {
+    "denoise": DenoiseStage,
+    "lut": LutStage,
+}
+
+
+def create_stages(config, shape, output_res, output_format, interpolation,
+                  crop_res, depth):
+    stages = []
+    for entry in config:
+        if isinstance(entry, str):
+            entry = {"stage": entry}
+        options = dict(entry)
+        name = options.pop("stage")
+        # the built in stages drop out when there is nothing for them to do
+        if name == "framing":
+            if crop_res is None:
+                continue
+            stage = CropStage(shape, crop_res)
+        elif name == "resize":
+            if shape[:2] == (output_res[1], output_res[0]):
+                continue
+            stage = ResizeStage(shape, output_res, interpolation, depth)
+        elif name == "convert":
+            if output_format == "BGR":
+                continue
+            stage = ConvertStage(shape, output_format, depth)
+        elif name in STAGES:
+            stage = STAGES[name](shape, depth, **options)
+        else:
+            raise ValueError(f"Unknown stage '{name}'")
+        stages.append(stage)
+        shape = stage.shape
+    if shape != frame_shape(output_res[0], output_res[1], output_format):
+        raise ValueError("The stages don't end with the output resolution and "
+                         "format, resize and convert have to come last")
+    return stages
+
+
+class StageJob:
+
+    def __init__(self, slot, index, crop):
+        self.slot = slot
+        self.index = index
+        self.crop = crop
+        self.future = None
+        self.frame = None
+        self.times = []
+
+
+class StagePipeline:
+
+    def __init__(self, stages, num_workers=2, max_in_flight=1, labels=None):
+        self.stages = stages
+        self.max_in_flight = max_in_flight
+        # one frame in flight runs in the grab loop itself
+        self.executor = None
+        if max_in_flight > 1:
+            self.executor = ThreadPoolExecutor(num_workers)
+        self.in_flight = deque()
+        self.num_jobs = 0
+        self.stage_times = {stage.name: metrics.histogram(
+            "pipeline_stage_seconds", stage=stage.name, **(labels or {}))
+            for stage in stages}
+
+    @staticmethod
+    def depth(max_in_flight):
+        # buffers per stage, the frames in flight and the one being sent
+        return max_in_flight + 1
+
+    def update_settings(self):
+        for stage in self.stages:
+            if hasattr(stage, "update_settings"):
+                stage.update_settings()
+
+    def run(self, job):
+        frame = job.slot.array
+        for stage in self.stages:
+            start_time = time.perf_counter()
+            frame = stage.process(frame, job)
+            job.times.append(time.perf_counter() - start_time)
+        return frame
+
+    def submit(self, slot, crop=None):
+        slot.retain()
+        job = StageJob(slot, self.num_jobs % self.depth(self.max_in_flight), crop)
+        self.num_jobs += 1
+        if self.executor is None:
+            job.frame = self.run(job)
+        else:
+            job.future = self.executor.submit(self.run, job)
+        self.in_flight.append(job)
+
+    def next_output(self):
+        # frames come out in the order they went in, and only once the
+        # pipeline is full, which bounds the latency to max_in_flight frames
+        if len(self.in_flight) < self.max_in_flight:
+            return None
+        return self.collect()
+
+    def collect(self):
+        job = self.in_flight.popleft()
+        if not job.future is None:
+            job.frame = job.future.result()
+        for stage, stage_time in zip(self.stages, job.times):
+            self.stage_times[stage.name].observe(stage_time)
+        return job
+
+    def close(self):
+        while len(self.in_flight) > 0:
+            self.collect().slot.release()
+        if not self.executor is None:
+            self.executor.shutdown()